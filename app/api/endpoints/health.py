@@ -0,0 +1,18 @@
+from fastapi import APIRouter, status
+from fastapi.responses import JSONResponse
+
+from ...warmup import warmup
+
+router = APIRouter()
+
+
+@router.get("/healthz")
+async def get_health() -> dict:
+    return {"status": "ok"}
+
+
+@router.get("/readyz")
+async def get_readiness() -> JSONResponse:
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if warmup.ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content=warmup.stats())
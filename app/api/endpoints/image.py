@@ -1,65 +1,84 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, Header, Response
-from sqlalchemy.orm import Session, joinedload
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, Header, Query, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+from typing import List, Optional, Tuple
 
 from app.api.validation.exceptions import ImageValidationException
-from app.config import UPLOAD_SIZE_LIMIT_BYTES
+from app.api.validation.image import MAGIC_BYTES_LEN, detect_mime_type, sniff_image_stream, validate_model, \
+    validate_size
+from ... import crud
 from ... import schemas
 from ... import models
-from ...tasks.upload import get_image_buffer_test, upload_original
-from ...tasks.transform import create_transformed_image
+from ...tasks.upload import delete_image, get_image_buffer, get_image_content, head_image, presign_download, \
+    presign_upload, upload_original, upload_original_stream
+from ...tasks.queue import schedule_transform, schedule_transforms
+from ...tasks.upload_registry import upload_registry
+from ...config import LINEAGE_MAX_DEPTH, LIST_PAGE_SIZE, LIST_PAGE_SIZE_MAX, S3_PRESIGN_EXPIRES_SECONDS, \
+    STATUS_STREAM_MAX_IMAGES, STATUS_STREAM_HEARTBEAT_SECONDS
 from ...database import SessionLocal
+from ...notify import RESYNC, status_hub
+from ...ratelimit import rate_limiter
 from datetime import datetime
-from uuid import UUID
-from ...models import Image
+from uuid import UUID, uuid4
+from hashlib import sha256
+from fastapi.responses import StreamingResponse
+import asyncio
 import base64
+import json
 
 router = APIRouter()
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-def get_userId(x_user_id: str = Header(None)):
+async def get_userId(x_user_id: str = Header(None)):
     if x_user_id is None:
         raise HTTPException(status_code=401, detail="X-User-Id header missing")
+    await rate_limiter.check("requests", x_user_id)
     return x_user_id
 
 
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    # Weak comparison, as GET allows
+    return etag.removeprefix("W/") in [tag.removeprefix("W/") for tag in tags]
+
+
+def encode_cursor(created_at: datetime, image_id: UUID) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{image_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, UUID]:
+    try:
+        created_at, image_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), UUID(image_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
 @router.post("/image")
 async def create_image(
     background_tasks: BackgroundTasks,
     body: schemas.CreateImage,
     userId: str = Depends(get_userId),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ) -> schemas.Image:
+    validate_model(body.operationType, body.modelType)
+    # 1. Validate that file size is less than the limit, before and after decoding
+    validate_size(len(body.image) * 3 // 4 - 2)
     file_bytes = base64.b64decode(body.image)
-    file_type = 'Unknown'
     file_size = len(file_bytes)
+    validate_size(file_size)
+    await rate_limiter.check("upload_bytes", userId, file_size)
 
-    if file_bytes.startswith(b'\xff\xd8'):
-        file_type = 'image/jpeg'
-    elif file_bytes.startswith(b'\x89PNG\r\n\x1a\n'):
-        file_type = 'image/png'
-    else:
-        raise ImageValidationException(
-            type="unsupportedFormat",
-            info="This image type is currently not supported"
-        )
-    
+    file_type = detect_mime_type(file_bytes[:MAGIC_BYTES_LEN])
     extension = file_type.split('/')[1]
-
-    # 1. Validate that file size is less than 12MB
-    if file_size > UPLOAD_SIZE_LIMIT_BYTES:
-        raise ImageValidationException(
-            name="Image too large",
-            info="File size exceeds limit of 12MB",
-            type="imageTooLarge"
-        )
+    content_hash = sha256(file_bytes).hexdigest()
 
     # 2. Insert new record to the Image db and get UUID imageId in return
     original_image = models.Image(
@@ -69,12 +88,25 @@ async def create_image(
         modelType=body.modelType,
         sizeBytes=file_size,
         mimeType=file_type,
+        contentHash=content_hash,
         status="processing"  # assuming initial status is 'processing'
     )
 
+    # Same content is stored already, share its object instead of uploading
+    stored = await crud.find_stored_content(db, content_hash, file_type)
+    if stored is not None:
+        original_image.objectId = stored.storageId
+        original_image.etag = stored.etag
+        original_image.uploadedAt = datetime.now()
+        original_image.status = "ready"
+
     db.add(original_image)
-    db.commit()
-    db.refresh(original_image)
+    await db.commit()
+
+    # 3. Start image uploading without blocking, transforms don't wait for
+    # it, they start from the bytes in hand
+    if stored is None:
+        upload_registry.start(original_image.imageId, upload_original(file_bytes, original_image.imageId, extension))
 
     children: List = []
 
@@ -86,38 +118,220 @@ async def create_image(
             modelType=body.modelType,
             mimeType=file_type,
             fromImageId=original_image.imageId,
-            status="processing"  # assuming initial status is 'processing'
+            status="processing",  # assuming initial status is 'processing'
+            children=[]
         )
         db.add(transform_image)
-        db.commit()
-        db.refresh(transform_image)
+        await db.flush()
+        # 4. Set a task for processing, queued along with the child record
+        await schedule_transform(db, background_tasks, original_image,
+                                 extension, transform_image, body.operationType, body.modelType, file_bytes)
+        await db.commit()
         children.append(transform_image)
 
-    # 3. Start image uploading background task without blocking
-    background_tasks.add_task(upload_original, file_bytes,
-                              original_image.imageId, extension, db)
+    # Loaded as is, without back references, which would make a cycle in response
+    set_committed_value(original_image, "children", children)
+    return original_image
 
-    # 4. Set a task for processing if required
-    for child in children:
-        background_tasks.add_task(create_transformed_image, original_image.imageId,
-                                  extension, child.imageId, body.operationType, body.modelType)
 
-    original_image.children = children
+@router.post("/image/stream")
+async def create_image_stream(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    operationType: Optional[schemas.OperationType] = None,
+    modelType: schemas.ModelType = schemas.ModelType.internal,
+    userId: str = Depends(get_userId),
+    db: AsyncSession = Depends(get_db)
+) -> schemas.Image:
+    """
+    Same as POST /image, but takes the raw image bytes as request body and
+    streams them to S3 while validating, without buffering the whole file
+    """
+    validate_model(operationType, modelType)
+    content_length = request.headers.get("content-length")
+    declared_size = int(content_length) if content_length is not None and content_length.isdigit() else None
+    if declared_size is not None:
+        validate_size(declared_size)
+        await rate_limiter.check("upload_bytes", userId, declared_size)
+
+    # 1. Sniff type from the first chunk, size is checked while streaming
+    file_type, chunks = await sniff_image_stream(request.stream())
+    extension = file_type.split('/')[1]
+
+    # 2. Upload within the request, so the record is inserted as ready
+    image_id = uuid4()
+    file_size, etag, content_hash = await upload_original_stream(chunks, image_id, extension)
+    if declared_size is None:
+        # Chunked body, charged once its size is known, next uploads wait it out
+        await rate_limiter.check("upload_bytes", userId, file_size, force=True)
+
+    original_image = models.Image(
+        imageId=image_id,
+        type="original",
+        userId=userId,
+        createdAt=datetime.now(),
+        uploadedAt=datetime.now(),
+        modelType=modelType,
+        sizeBytes=file_size,
+        mimeType=file_type,
+        etag=etag,
+        contentHash=content_hash,
+        status="ready"
+    )
+    db.add(original_image)
+
+    children: List = []
+
+    if operationType is not None:
+        transform_image = models.Image(
+            type=operationType,
+            userId=userId,
+            createdAt=datetime.now(),
+            modelType=modelType,
+            mimeType=file_type,
+            fromImageId=image_id,
+            status="processing",
+            children=[]
+        )
+        db.add(transform_image)
+        await db.flush()
+        # 3. Set a task for processing if required
+        await schedule_transform(db, background_tasks, original_image,
+                                 extension, transform_image, operationType, modelType)
+        children.append(transform_image)
+
+    await db.commit()
+
+    set_committed_value(original_image, "children", children)
     return original_image
 
 
+@router.post("/image/presigned", response_model=schemas.PresignedUpload)
+async def create_image_presigned(
+    body: schemas.CreatePresignedImage,
+    userId: str = Depends(get_userId),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Same as POST /image, but bytes go straight to S3: returns a presigned PUT
+    URL for the original, which waits as processing until
+    POST /image/{imageId}/complete. Transforms start on completion
+    """
+    validate_model(body.operationType, body.modelType)
+    validate_size(body.sizeBytes)
+    await rate_limiter.check("upload_bytes", userId, body.sizeBytes)
+    extension = body.mimeType.value.split('/')[1]
+
+    original_image = models.Image(
+        imageId=uuid4(),
+        type="original",
+        userId=userId,
+        createdAt=datetime.now(),
+        modelType=body.modelType,
+        mimeType=body.mimeType.value,
+        # Declared size, what's charged to the user and signed into the URL
+        sizeBytes=body.sizeBytes,
+        status="processing"
+    )
+    db.add(original_image)
+
+    children: List = []
+
+    if body.operationType is not None:
+        transform_image = models.Image(
+            type=body.operationType,
+            userId=userId,
+            createdAt=datetime.now(),
+            modelType=body.modelType,
+            mimeType=body.mimeType.value,
+            fromImageId=original_image.imageId,
+            status="processing",
+            children=[]
+        )
+        db.add(transform_image)
+        children.append(transform_image)
+
+    await db.commit()
+
+    set_committed_value(original_image, "children", children)
+    return {
+        "image": original_image,
+        "uploadUrl": await presign_upload(original_image.imageId, extension, original_image.mimeType, body.sizeBytes),
+        "uploadHeaders": {"Content-Type": original_image.mimeType, "Content-Length": str(body.sizeBytes)},
+        "expiresIn": S3_PRESIGN_EXPIRES_SECONDS,
+    }
+
+
+@router.post("/image/{imageId}/complete", response_model=schemas.Image)
+async def complete_image_upload(
+    background_tasks: BackgroundTasks,
+    imageId: UUID,
+    userId: str = Depends(get_userId),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Checks the object uploaded to a presigned URL, size with HEAD against
+    the declared one and type from its first bytes, marks the original ready
+    and starts transforms of its children. Completing again is a no-op
+    """
+    image = await crud.get_image(db, imageId, userId)
+
+    if image is None or image.type != "original":
+        raise HTTPException(status_code=404, detail="Not found")
+
+    extension = 'jpeg' if image.mimeType == 'image/jpeg' else 'png'
+
+    if image.status == "processing":
+        stored = await head_image(imageId, extension, MAGIC_BYTES_LEN)
+        if stored is None:
+            raise HTTPException(status_code=409, detail="Not uploaded yet")
+        size, etag, head = stored
+
+        try:
+            validate_size(size)
+            if size != image.sizeBytes:
+                raise ImageValidationException(
+                    type="sizeMismatch",
+                    info=f"Uploaded {size} bytes, {image.sizeBytes} declared")
+            if detect_mime_type(head) != image.mimeType:
+                raise ImageValidationException(
+                    type="unsupportedFormat",
+                    info=f"Uploaded image is not {image.mimeType}")
+        except ImageValidationException:
+            # Nothing is kept of an invalid upload, children fail with it
+            await delete_image(imageId, extension)
+            await crud.set_image_status(db, imageId, "error")
+            for child in await crud.get_pending_children(db, imageId):
+                await crud.set_image_status(db, child.imageId, "error")
+            await db.commit()
+            raise
+
+        if await crud.mark_uploaded(db, imageId, uploadedAt=datetime.now(), sizeBytes=size, etag=etag):
+            set_committed_value(image, "status", "ready")
+            await schedule_transforms(db, background_tasks, image, extension,
+                                      await crud.get_pending_children(db, imageId))
+        await db.commit()
+
+    children = await crud.list_children(db, userId, [imageId])
+    # Session is closed only after background transforms, not held open through them
+    await db.commit()
+    set_committed_value(image, "children", [dict(child._mapping) for child in children])
+    return image
+
+
 @router.post("/image/{imageId}/child")
 async def create_image(
     background_tasks: BackgroundTasks,
     imageId: UUID,
     createImage: schemas.CreateChildImage,
     userId: str = Depends(get_userId),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ) -> models.Image:
-    image = db.query(Image).filter(
-        Image.imageId == imageId,
-        Image.userId == userId).one_or_none()
-    db.commit()
+    validate_model(createImage.operationType, createImage.modelType)
+    image = await crud.get_image(db, imageId, userId)
+
+    if image is None:
+        raise HTTPException(status_code=404, detail="Not found")
 
     transform_image = models.Image(
         type=createImage.operationType,
@@ -126,77 +340,239 @@ async def create_image(
         modelType=createImage.modelType,
         mimeType=image.mimeType,
         fromImageId=imageId,
-        status="processing"  # assuming initial status is 'processing'
+        status="processing",  # assuming initial status is 'processing'
+        children=[]
     )
     db.add(transform_image)
-    db.commit()
-    db.refresh(transform_image)
+    await db.flush()
     extension = 'jpeg' if image.mimeType == 'image/jpeg' else 'png'
 
-    background_tasks.add_task(create_transformed_image, imageId,
-                              extension, transform_image.imageId, createImage.operationType, createImage.modelType)
+    await schedule_transform(db, background_tasks, image,
+                             extension, transform_image, createImage.operationType, createImage.modelType)
+    await db.commit()
 
     return transform_image
 
 
+@router.post("/image/{imageId}/children", response_model=list[schemas.Image])
+async def create_images(
+    background_tasks: BackgroundTasks,
+    imageId: UUID,
+    createImages: schemas.CreateChildImages,
+    userId: str = Depends(get_userId),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Several children of one parent in a single insert, transforms share
+    a single fetch of the parent
+    """
+    for createImage in createImages.children:
+        validate_model(createImage.operationType, createImage.modelType)
+    image = await crud.get_image(db, imageId, userId)
+
+    if image is None:
+        raise HTTPException(status_code=404, detail="Not found")
+
+    transform_images = [
+        models.Image(
+            type=createImage.operationType,
+            userId=userId,
+            createdAt=datetime.now(),
+            modelType=createImage.modelType,
+            mimeType=image.mimeType,
+            fromImageId=imageId,
+            status="processing",
+            children=[]
+        )
+        for createImage in createImages.children
+    ]
+    db.add_all(transform_images)
+    await db.flush()
+    extension = 'jpeg' if image.mimeType == 'image/jpeg' else 'png'
+
+    await schedule_transforms(db, background_tasks, image, extension, transform_images)
+    await db.commit()
+
+    return transform_images
+
+
 @router.get("/image/{imageId}/download")
 async def download_image(
     imageId: UUID,
     response: Response,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     userId: str = Depends(get_userId)):
-    image = db.query(Image).filter(
-        Image.imageId == imageId,
-        Image.status == 'ready',
-        Image.userId == userId).one_or_none()
-    db.commit()
+    image = await crud.get_ready_image(db, imageId, userId)
+    # Back to the pool, rather than held idle in transaction while S3 is read
+    await db.commit()
 
     if image is None:
         raise HTTPException(status_code=404, detail="Not found")
 
     extension = 'jpeg' if image.mimeType == 'image/jpeg' else 'png'
 
-    image_b64 = base64.b64encode(get_image_buffer_test(image.imageId, extension).read())
+    image_b64 = base64.b64encode(await get_image_buffer(image.storageId, extension, image.etag))
 
     return {
       "mimeType":image.mimeType,
       "image":image_b64,      
       }
 
+@router.get("/image/{imageId}/download/raw")
+async def download_image_raw(
+    imageId: UUID,
+    range: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+    userId: str = Depends(get_userId)):
+    image = await crud.get_ready_image(db, imageId, userId)
+    # Back to the pool, rather than held idle in transaction while S3 is read
+    await db.commit()
+
+    if image is None:
+        raise HTTPException(status_code=404, detail="Not found")
+
+    # Answer from the stored ETag, without touching S3 at all
+    if if_none_match and image.etag and etag_matches(if_none_match, image.etag):
+        return Response(status_code=304, headers={"etag": image.etag})
+
+    extension = 'jpeg' if image.mimeType == 'image/jpeg' else 'png'
+
+    return await get_image_content(image.storageId, extension, image.mimeType,
+                                   byte_range=range, if_none_match=if_none_match, etag=image.etag)
+
+
+@router.get("/image/{imageId}/download/url", response_model=schemas.PresignedDownload)
+async def download_image_url(
+    imageId: UUID,
+    db: AsyncSession = Depends(get_db),
+    userId: str = Depends(get_userId)):
+    """Presigned GET URL, bytes are then read from S3 directly"""
+    image = await crud.get_ready_image(db, imageId, userId)
+    # Back to the pool, rather than held idle in transaction while S3 is read
+    await db.commit()
+
+    if image is None:
+        raise HTTPException(status_code=404, detail="Not found")
+
+    extension = 'jpeg' if image.mimeType == 'image/jpeg' else 'png'
+
+    return {
+        "url": await presign_download(image.storageId, extension),
+        "mimeType": image.mimeType,
+        "expiresIn": S3_PRESIGN_EXPIRES_SECONDS,
+    }
+
+
 @router.get("/image", response_model=list[schemas.Image])
-async def list_images(db: Session = Depends(get_db), userId: str = Depends(get_userId)):
-    image = db.query(models.Image).filter(
-        models.Image.userId == userId).all()
-    db.commit()
-    return image
+async def list_images(
+    response: Response,
+    limit: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_PAGE_SIZE_MAX),
+    cursor: Optional[str] = None,
+    status: Optional[schemas.ImageStatus] = None,
+    type: Optional[schemas.ImageType] = None,
+    db: AsyncSession = Depends(get_db),
+    userId: str = Depends(get_userId)):
+    """
+    Page of user's images, newest first, with their direct children.
+    Cursor of the next page is returned in X-Next-Cursor, if there may be one
+    """
+    after = decode_cursor(cursor) if cursor else None
+
+    images = await crud.list_images(db, userId, limit, after, status, type)
+    children = await crud.list_children(db, userId, [image.imageId for image in images])
+
+    children_of = {}
+    for child in children:
+        children_of.setdefault(child.fromImageId, []).append(dict(child._mapping))
+
+    if len(images) == limit:
+        response.headers["x-next-cursor"] = encode_cursor(images[-1].createdAt, images[-1].imageId)
+
+    return [{**image._mapping, "children": children_of.get(image.imageId, [])} for image in images]
 
 @router.get("/image/{imageId}", response_model=schemas.Image)
-async def get_image_object(imageId: UUID, userId: str = Depends(get_userId), db: Session = Depends(get_db)) -> schemas.Image:
-    models.Image.children.property.strategy.join_depth = 5
-    image = db.query(models.Image). \
-      filter(
-        models.Image.imageId == imageId,
-        models.Image.userId == userId). \
-      options(joinedload(Image.children)).  \
-      one_or_none()
-    db.commit()
-    
+async def get_image_object(imageId: UUID, userId: str = Depends(get_userId), db: AsyncSession = Depends(get_db)) -> schemas.Image:
+    image = await crud.get_image_tree(db, imageId, userId, LINEAGE_MAX_DEPTH)
+
     if image is None:
         raise HTTPException(status_code=404, detail="Not found")
 
     return image
 
 
+def status_event(image_id: UUID, status: str) -> str:
+    return f"event: status\ndata: {json.dumps({'imageId': str(image_id), 'status': status})}\n\n"
+
+
+@router.get("/image/status/stream")
+async def stream_image_status(
+    imageId: List[UUID] = Query(...),
+    userId: str = Depends(get_userId)):
+    """
+    Server-sent events with status of given images, current one first, then
+    every change, until none of them is processing anymore
+    """
+    if len(imageId) > STATUS_STREAM_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"At most {STATUS_STREAM_MAX_IMAGES} images per stream")
+
+    # Short-lived sessions, an open stream holds no DB connection
+    async def read_statuses():
+        async with SessionLocal() as db:
+            return await crud.get_image_statuses(db, imageId, userId)
+
+    if not await read_statuses():
+        raise HTTPException(status_code=404, detail="Not found")
+
+    async def events():
+        with status_hub.subscribe(imageId) as queue:
+            # Read again once subscribed, so no change is missed in between
+            changes = await read_statuses()
+            watched = set(changes)
+            current = {}
+
+            while True:
+                for image_id, status in changes.items():
+                    if current.get(image_id) != status:
+                        current[image_id] = status
+                        yield status_event(image_id, status)
+
+                if "processing" not in current.values():
+                    return
+
+                try:
+                    event = await asyncio.wait_for(queue.get(), STATUS_STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    changes = {}
+                    continue
+
+                if event is RESYNC:
+                    changes = await read_statuses()
+                elif UUID(event["imageId"]) in watched:
+                    changes = {UUID(event["imageId"]): event["status"]}
+                else:
+                    changes = {}
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"cache-control": "no-cache", "x-accel-buffering": "no"})
+
+
+@router.post("/image/status")
+async def get_image_statuses(
+    query: schemas.ImageStatusQuery,
+    db: AsyncSession = Depends(get_db),
+    userId: str = Depends(get_userId)) -> dict:
+    """Status of each of given images, those not found are left out"""
+    statuses = await crud.get_cached_image_statuses(db, query.imageIds, userId)
+    return {str(image_id): status for image_id, status in statuses.items()}
+
+
 @router.get("/image/{imageId}/status")
-async def get_image_status(imageId: UUID, db: Session = Depends(get_db), userId: str = Depends(get_userId)) -> schemas.ImageStatusResponse:
-    image = db.query(models.Image).filter(
-        models.Image.imageId == imageId,
-        models.Image.userId == userId). \
-        with_entities(models.Image.status). \
-          one_or_none()
-    db.commit()
+async def get_image_status(imageId: UUID, db: AsyncSession = Depends(get_db), userId: str = Depends(get_userId)) -> schemas.ImageStatusResponse:
+    status = (await crud.get_cached_image_statuses(db, [imageId], userId)).get(imageId)
 
-    if image is None:
+    if status is None:
         raise HTTPException(status_code=404, detail="Not found")
 
-    return {"status": image.status}
+    return {"status": status}
@@ -0,0 +1,82 @@
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from ...notify import status_hub
+from ...object_cache import object_cache
+from ...ratelimit import rate_limiter
+from ...s3 import s3_pool
+from ...status_cache import status_cache
+from ...tasks.buffers import buffer_manager
+from ...tasks.ml_client import ml_clients
+from ...tasks.ml_router import ml_router
+from ...tasks.preprocess import preprocessor
+from ...tasks.scheduler import fair_scheduler
+from ...tasks.transform_cache import cache_stats
+from ...tasks.upload_registry import upload_registry
+
+router = APIRouter()
+
+
+@router.get("/stats/s3")
+async def get_s3_stats() -> dict:
+    return s3_pool.stats()
+
+
+@router.get("/stats/ml")
+async def get_ml_stats() -> dict:
+    return ml_clients.stats()
+
+
+@router.get("/stats/routing")
+async def get_routing_stats() -> dict:
+    return ml_router.stats()
+
+
+@router.get("/stats/cache")
+async def get_cache_stats() -> dict:
+    return cache_stats.stats()
+
+
+@router.get("/stats/notify")
+async def get_notify_stats() -> dict:
+    return status_hub.stats()
+
+
+@router.get("/stats/status")
+async def get_status_cache_stats() -> dict:
+    return status_cache.stats()
+
+
+@router.get("/stats/preprocess")
+async def get_preprocess_stats() -> dict:
+    return preprocessor.stats()
+
+
+@router.get("/stats/buffers")
+async def get_buffer_stats() -> dict:
+    return buffer_manager.stats()
+
+
+@router.get("/stats/ratelimit")
+async def get_rate_limit_stats() -> dict:
+    return rate_limiter.stats()
+
+
+@router.get("/stats/scheduler")
+async def get_scheduler_stats() -> dict:
+    return fair_scheduler.stats()
+
+
+@router.get("/stats/uploads")
+async def get_upload_stats() -> dict:
+    return upload_registry.stats()
+
+
+@router.get("/stats/objects")
+async def get_object_cache_stats() -> dict:
+    return object_cache.stats()
+
+
+@router.get("/metrics")
+async def get_metrics() -> Response:
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
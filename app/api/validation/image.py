@@ -0,0 +1,67 @@
+from typing import AsyncIterator, Tuple
+
+from app.api.validation.exceptions import ImageValidationException
+from app.config import UPLOAD_SIZE_LIMIT_BYTES
+from app.schemas import ModelType, OperationType
+
+# Longest signature we sniff, PNG is 8 bytes
+MAGIC_BYTES_LEN = 8
+
+
+def detect_mime_type(head: bytes) -> str:
+    if head.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    elif head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+
+    raise ImageValidationException(
+        type="unsupportedFormat",
+        info="This image type is currently not supported"
+    )
+
+
+def validate_size(size: int):
+    if size > UPLOAD_SIZE_LIMIT_BYTES:
+        raise ImageValidationException(
+            type="imageTooLarge",
+            info=f"File size exceeds limit of {UPLOAD_SIZE_LIMIT_BYTES} bytes"
+        )
+
+
+def validate_model(task: OperationType, model: ModelType):
+    if model == ModelType.auto and task is not None and task != OperationType.background_remove:
+        raise ImageValidationException(
+            type="unsupportedModel",
+            info="Model auto is only available for background_remove"
+        )
+
+
+async def sniff_image_stream(chunks: AsyncIterator[bytes]) -> Tuple[str, AsyncIterator[bytes]]:
+    """
+    Reads just enough of `chunks` to detect the image type and returns it
+    together with an iterator replaying the whole stream, which raises
+    ImageValidationException as soon as the size limit is crossed
+    """
+    head = b""
+    iterator = chunks.__aiter__()
+
+    async for chunk in iterator:
+        head += chunk
+        if len(head) >= MAGIC_BYTES_LEN:
+            break
+
+    mime_type = detect_mime_type(head)
+
+    async def validated():
+        size = len(head)
+        validate_size(size)
+        yield head
+
+        async for chunk in iterator:
+            if not chunk:
+                continue
+            size += len(chunk)
+            validate_size(size)
+            yield chunk
+
+    return mime_type, validated()
@@ -0,0 +1,209 @@
+"""
+Image data access over async sessions. Functions only flush or execute,
+committing is up to the caller, so several changes can go in one transaction
+"""
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID
+
+from sqlalchemy import any_, bindparam, func, literal, select, tuple_, update
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased, undefer
+
+from .models import Image
+from .notify import STATUS_CHANNEL, status_payload
+from .status_cache import status_cache
+
+
+async def get_image(db: AsyncSession, image_id: UUID, user_id: str) -> Optional[Image]:
+    """User's image, with columns needed to derive children from it and to complete its upload"""
+    return await db.scalar(
+        select(Image)
+        .where(Image.imageId == image_id, Image.userId == user_id)
+        .options(undefer(Image.contentHash), undefer(Image.sizeBytes))
+    )
+
+
+# All that's listed of an image, `schemas.Image` without children
+LIST_COLUMNS = (Image.imageId, Image.type, Image.status, Image.fromImageId, Image.createdAt, Image.modelType)
+
+
+async def list_images(
+    db: AsyncSession,
+    user_id: str,
+    limit: int,
+    after: Optional[Tuple[datetime, UUID]] = None,
+    status: Optional[str] = None,
+    type: Optional[str] = None
+) -> List[Row]:
+    """
+    Page of user's images, newest first, starting after `after`, a
+    (createdAt, imageId) of the last image of previous page
+    """
+    query = select(*LIST_COLUMNS).where(Image.userId == user_id)
+    if status is not None:
+        query = query.where(Image.status == status)
+    if type is not None:
+        query = query.where(Image.type == type)
+    if after is not None:
+        query = query.where(tuple_(Image.createdAt, Image.imageId) < after)
+
+    result = await db.execute(
+        query
+        .order_by(Image.createdAt.desc(), Image.imageId.desc())
+        .limit(limit)
+    )
+    return result.all()
+
+
+async def get_image_tree(db: AsyncSession, image_id: UUID, user_id: str, max_depth: int) -> Optional[dict]:
+    """
+    User's image with its descendants up to `max_depth` levels down, as nested
+    dicts, loaded with a single recursive query
+    """
+    columns = [column.label(column.key) for column in LIST_COLUMNS]
+    lineage = (
+        select(*columns, literal(0).label("depth"))
+        .where(Image.imageId == image_id, Image.userId == user_id)
+        .cte("lineage", recursive=True)
+    )
+    child = aliased(Image)
+    lineage = lineage.union_all(
+        select(*[getattr(child, column.key).label(column.key) for column in LIST_COLUMNS], lineage.c.depth + 1)
+        .join(lineage, child.fromImageId == lineage.c.imageId)
+        .where(child.userId == user_id, lineage.c.depth < max_depth)
+    )
+
+    rows = (await db.execute(
+        select(lineage).order_by(lineage.c.depth, lineage.c.createdAt)
+    )).all()
+    if not rows:
+        return None
+
+    # Parents come before children, so each node is attached once its parent exists
+    nodes = {}
+    for row in rows:
+        node = {column.key: row._mapping[column.key] for column in LIST_COLUMNS}
+        node["children"] = []
+        nodes[node["imageId"]] = node
+        if row.depth:
+            nodes[node["fromImageId"]]["children"].append(node)
+
+    return nodes[rows[0].imageId]
+
+
+async def list_children(db: AsyncSession, user_id: str, image_ids: List[UUID]) -> List[Row]:
+    """Direct children of given images, oldest first"""
+    if not image_ids:
+        return []
+
+    result = await db.execute(
+        select(*LIST_COLUMNS)
+        .where(Image.fromImageId.in_(image_ids), Image.userId == user_id)
+        .order_by(Image.createdAt)
+    )
+    return result.all()
+
+
+async def get_ready_image(db: AsyncSession, image_id: UUID, user_id: str) -> Optional[Row]:
+    """What's needed to serve a download of user's ready image"""
+    result = await db.execute(
+        select(Image.imageId, Image.storageId.label("storageId"), Image.mimeType, Image.etag)
+        .where(
+            Image.imageId == image_id,
+            Image.status == 'ready',
+            Image.userId == user_id)
+    )
+    return result.one_or_none()
+
+
+async def find_stored_content(db: AsyncSession, content_hash: str, mime_type: str) -> Optional[Row]:
+    """Any uploaded image with the same content, whoever it belongs to"""
+    result = await db.execute(
+        select(Image.imageId, Image.storageId.label("storageId"), Image.etag)
+        .where(
+            Image.contentHash == content_hash,
+            Image.mimeType == mime_type,
+            Image.status == 'ready')
+        .limit(1)
+    )
+    return result.one_or_none()
+
+
+async def get_content_hash(db: AsyncSession, image_id: UUID) -> Optional[str]:
+    return await db.scalar(select(Image.contentHash).where(Image.imageId == image_id))
+
+
+async def get_image_statuses(db: AsyncSession, image_ids: List[UUID], user_id: str) -> Dict[UUID, str]:
+    """
+    Statuses of those of given images that are user's. Ids go as one array
+    parameter, so any number of them makes the same prepared statement
+    """
+    ids = bindparam("image_ids", list(image_ids), type_=ARRAY(Image.imageId.type))
+    result = await db.execute(
+        select(Image.imageId, Image.status)
+        .where(Image.imageId == any_(ids), Image.userId == user_id)
+    )
+    return {row.imageId: row.status for row in result}
+
+
+async def get_cached_image_statuses(db: AsyncSession, image_ids: List[UUID], user_id: str) -> Dict[UUID, str]:
+    """get_image_statuses, reading only images not in status_cache"""
+    statuses, missing = status_cache.get_many(image_ids, user_id)
+    if missing:
+        read = await get_image_statuses(db, missing, user_id)
+        status_cache.put_many(user_id, read)
+        statuses.update(read)
+    return statuses
+
+
+async def update_image(db: AsyncSession, image_id: UUID, **values):
+    """Status changes are published to subscribers once the transaction commits"""
+    query = (
+        update(Image)
+        .where(Image.imageId == image_id)
+        .values(values)
+    )
+    if "status" not in values:
+        await db.execute(query)
+        return
+
+    # Dropped again once notified of the commit, a read in between may cache the old one
+    status_cache.invalidate(image_id)
+    user_id = (await db.execute(query.returning(Image.userId))).scalar_one_or_none()
+    if user_id is not None:
+        await db.execute(select(func.pg_notify(STATUS_CHANNEL, status_payload(image_id, user_id, values["status"]))))
+
+
+async def mark_uploaded(db: AsyncSession, image_id: UUID, **values) -> bool:
+    """
+    Marks an original waiting for its upload as ready, False if it isn't
+    waiting anymore, so only one of concurrent completions goes on
+    """
+    status_cache.invalidate(image_id)
+    user_id = (await db.execute(
+        update(Image)
+        .where(Image.imageId == image_id, Image.status == "processing")
+        .values(status="ready", **values)
+        .returning(Image.userId)
+    )).scalar_one_or_none()
+    if user_id is None:
+        return False
+    await db.execute(select(func.pg_notify(STATUS_CHANNEL, status_payload(image_id, user_id, "ready"))))
+    return True
+
+
+async def get_pending_children(db: AsyncSession, image_id: UUID) -> List[Image]:
+    """Children still to be transformed, with what's needed to schedule them"""
+    return (await db.scalars(
+        select(Image)
+        .where(Image.fromImageId == image_id, Image.status == "processing")
+        .options(undefer(Image.userId))
+        .order_by(Image.createdAt)
+    )).all()
+
+
+async def set_image_status(db: AsyncSession, image_id: UUID, status: str):
+    await update_image(db, image_id, status=status)
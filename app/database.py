@@ -1,9 +1,15 @@
-import os
-from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from .config import SQLALCHEMY_DATABASE_URL, DEBUG_SQL
+from .config import ASYNC_DATABASE_URL, DEBUG_SQL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=DEBUG_SQL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    echo=DEBUG_SQL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=True)
+# Loaded objects stay usable after commit, refreshing them would need another await
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
@@ -1,18 +1,73 @@
+import asyncio
+import math
+
 from fastapi import FastAPI, status
 
 from app.api.validation.exceptions import ImageValidationException
-from .api.endpoints import image
-from .database import engine
-from . import models
+from .api.endpoints import health, image, stats
+from .config import METRICS_REQUEST_TIMING, TRANSFORM_CACHE_ENABLED, TRANSFORM_CACHE_EVICT_INTERVAL
+from .database import SessionLocal, engine
+from .metrics import RequestTimingMiddleware
+from .notify import status_hub
+from .object_cache import object_cache
+from .ratelimit import RateLimitExceeded
+from .s3 import s3_pool
+from .tasks.ml_client import ml_clients
+from .tasks.preprocess import preprocessor
+from .tasks.transform_cache import evict_transform_cache
+from .tasks.upload_registry import upload_registry
+from .warmup import warmup
 from fastapi.responses import JSONResponse
 
-models.Base.metadata.create_all(bind=engine)
-
 app = FastAPI()
 
+if METRICS_REQUEST_TIMING:
+    app.add_middleware(RequestTimingMiddleware)
+
+async def evict_transform_cache_periodically():
+    while True:
+        try:
+            async with SessionLocal() as db:
+                evicted = await evict_transform_cache(db)
+            print(f"Evicted {evicted} transform cache entries")
+        except Exception as e:
+            print(f"Transform cache eviction failed: {e} ({type(e)})")
+        await asyncio.sleep(TRANSFORM_CACHE_EVICT_INTERVAL)
+
+background_loops = []
+
+@app.on_event("startup")
+async def startup():
+    # Schema is up to `python -m app.migrate`, clients connect on first use or warm-up
+    warmup.start()
+    status_hub.start()
+    if TRANSFORM_CACHE_ENABLED:
+        background_loops.append(asyncio.create_task(evict_transform_cache_periodically()))
+
+@app.on_event("shutdown")
+async def shutdown():
+    await warmup.close()
+    for loop in background_loops:
+        loop.cancel()
+    await status_hub.close()
+    await upload_registry.close()
+    await s3_pool.close()
+    await ml_clients.close()
+    preprocessor.close()
+    object_cache.close()
+    await engine.dispose()
+
 @app.exception_handler(ImageValidationException)
 async def image_validation_exc_handler(_, exc: ImageValidationException):
     return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, 
         content={"errorType": exc.type, "error": exc.info})
 
-app.include_router(image.router)
\ No newline at end of file
+@app.exception_handler(RateLimitExceeded)
+async def rate_limit_exc_handler(_, exc: RateLimitExceeded):
+    return JSONResponse(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        headers={"Retry-After": str(math.ceil(exc.retry_after))},
+        content={"errorType": "rateLimited", "error": f"Over {exc.limit} limit, retry in {exc.retry_after:.1f}s"})
+
+app.include_router(health.router)
+app.include_router(image.router)
+app.include_router(stats.router)
@@ -0,0 +1,142 @@
+"""
+Prometheus metrics of the process, served on /metrics (and by workers on
+METRICS_WORKER_PORT). Pool gauges are read from the pools at scrape time
+"""
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Iterator, Optional, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from .database import engine
+from .s3 import s3_pool
+from .schemas import ModelType, OperationType
+from .tasks.buffers import buffer_manager
+from .tasks.scheduler import fair_scheduler
+
+# Stages take from milliseconds (DB update) to minutes (ML call with retries)
+STAGE_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+TRANSFORM_STAGE_SECONDS = Histogram(
+    "transform_stage_seconds",
+    "Time spent in each stage of a transform: wait (for parent upload), admission, fetch, "
+    "preprocess, encode, ml_call, tile_split, stitch, upload, db_update",
+    ["stage", "operation", "model"], buckets=STAGE_BUCKETS)
+TRANSFORM_SECONDS = Histogram(
+    "transform_seconds", "Whole transform, from scheduling to ready or failed",
+    ["operation", "model"], buckets=STAGE_BUCKETS)
+TRANSFORMS_TOTAL = Counter(
+    "transforms_total", "Finished transforms by outcome: ready, circuit_open, ml_error, error",
+    ["operation", "model", "outcome"])
+TRANSFORMS_IN_FLIGHT = Gauge("transforms_in_flight", "Transforms being processed", ["operation", "model"])
+
+ML_RETRIES_TOTAL = Counter("ml_retries_total", "ML calls retried after a failed attempt", ["model"])
+ML_AUTO_ROUTED_TOTAL = Counter(
+    "ml_auto_routed_total", "ML calls of `auto` transforms by backend the result came from", ["model"])
+ML_HEDGES_TOTAL = Counter(
+    "ml_hedges_total", "Hedged duplicate ML calls by which one won: primary, hedge, none (both failed)", ["winner"])
+BYTES_TOTAL = Counter(
+    "bytes_total", "Bytes moved: s3_read, s3_write, ml_sent, ml_received", ["direction"])
+UPLOADS_IN_FLIGHT = Gauge("s3_uploads_in_flight", "Objects being uploaded to S3")
+RATE_LIMITED_TOTAL = Counter("rate_limited_total", "Requests refused over a per-user limit", ["limit"])
+OBJECT_CACHE_REQUESTS_TOTAL = Counter(
+    "object_cache_requests_total", "Object reads by local disk cache result: hit, miss", ["result"])
+OBJECT_CACHE_EVICTIONS_TOTAL = Counter(
+    "object_cache_evictions_total", "Objects evicted from local disk cache to stay within its size")
+OBJECT_CACHE_BYTES = Gauge("object_cache_bytes", "Bytes of objects held in local disk cache")
+
+REQUEST_SECONDS = Histogram(
+    "http_request_seconds", "Requests until the last byte of response is sent, by route template",
+    ["method", "route", "status"])
+
+DB_POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "DB connections in use")
+DB_POOL_CHECKED_OUT.set_function(lambda: engine.pool.checkedout())
+DB_POOL_OVERFLOW = Gauge("db_pool_overflow", "DB connections open beyond pool size")
+DB_POOL_OVERFLOW.set_function(lambda: max(engine.pool.overflow(), 0))
+S3_POOL_IN_USE = Gauge("s3_pool_in_use", "S3 client slots in use")
+S3_POOL_IN_USE.set_function(lambda: s3_pool.in_use)
+S3_POOL_WAITING = Gauge("s3_pool_waiting", "Callers waiting for an S3 client slot")
+S3_POOL_WAITING.set_function(lambda: s3_pool.waiting)
+TRANSFORM_MEMORY_RESERVED = Gauge("transform_memory_reserved_bytes", "Bytes of memory budget held by transforms")
+TRANSFORM_MEMORY_RESERVED.set_function(lambda: buffer_manager.reserved)
+TRANSFORM_MEMORY_WAITING = Gauge("transform_memory_waiting", "Transforms queued for their share of memory budget")
+TRANSFORM_MEMORY_WAITING.set_function(lambda: buffer_manager.waiting)
+SCHEDULER_RUNNING = Gauge("transform_scheduler_running", "Background transforms holding a scheduler slot")
+SCHEDULER_RUNNING.set_function(lambda: fair_scheduler.running)
+SCHEDULER_WAITING = Gauge("transform_scheduler_waiting", "Background transforms waiting for their user's turn")
+SCHEDULER_WAITING.set_function(lambda: fair_scheduler.waiting)
+
+
+def transform_labels(task: OperationType, model: ModelType) -> Tuple[str, str]:
+    return OperationType(task).value, ModelType(model).value
+
+
+def stage_timer(stage: str, task: Optional[OperationType] = None, model: Optional[ModelType] = None):
+    """
+    Context manager observing time of `stage` of a `task`/`model` transform,
+    stages shared by a batch of transforms are labelled `batch`
+    """
+    labels = transform_labels(task, model) if task is not None else ("batch", "batch")
+    return TRANSFORM_STAGE_SECONDS.labels(stage, *labels).time()
+
+
+@contextmanager
+def track_transform(task: OperationType, model: ModelType, started: Optional[float] = None) -> Iterator[None]:
+    """Transform in flight while inside, its time since `started` or entering is observed on exit"""
+    labels = transform_labels(task, model)
+    started = perf_counter() if started is None else started
+    TRANSFORMS_IN_FLIGHT.labels(*labels).inc()
+    try:
+        yield
+    finally:
+        TRANSFORMS_IN_FLIGHT.labels(*labels).dec()
+        TRANSFORM_SECONDS.labels(*labels).observe(perf_counter() - started)
+
+
+def count_transform(task: OperationType, model: ModelType, outcome: str):
+    TRANSFORMS_TOTAL.labels(*transform_labels(task, model), outcome).inc()
+
+
+class RequestTimingMiddleware:
+    """
+    Observes every HTTP request into REQUEST_SECONDS, up to the last body
+    message, so background tasks run after the response aren't counted
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.routes = None
+
+    def route(self, scope) -> str:
+        if self.routes is None:
+            self.routes = {route.endpoint: route.path for route in scope["app"].routes}
+        return self.routes.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = perf_counter()
+        status = 500
+        observed = False
+
+        def observe():
+            nonlocal observed
+            if not observed:
+                observed = True
+                REQUEST_SECONDS.labels(scope["method"], self.route(scope), str(status)) \
+                    .observe(perf_counter() - started)
+
+        async def timed_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                observe()
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            observe()
@@ -0,0 +1,71 @@
+"""
+Schema migration, run once per deploy before API and workers start, which
+don't touch the schema themselves. create_all only creates missing tables
+along with their types and indexes, tables already there are left as they
+are. On Postgres, columns and indexes added to those since are applied
+after it by UPGRADES and INDEXES, and values added to enum types, all
+idempotent. Run from repo root:
+
+    python -m app.migrate
+"""
+import asyncio
+from time import perf_counter
+
+from sqlalchemy import Enum, text
+
+from .database import engine
+from .models import Base
+
+# Columns added to tables of a deployed schema, in order
+UPGRADES = [
+    "ALTER TABLE image ADD COLUMN IF NOT EXISTS etag VARCHAR",
+    "ALTER TABLE image ADD COLUMN IF NOT EXISTS content_hash VARCHAR",
+    "ALTER TABLE image ADD COLUMN IF NOT EXISTS object_id UUID",
+]
+
+# Indexes added to tables of a deployed schema. Built CONCURRENTLY, so
+# writes to the table go on meanwhile; a build that failed halfway leaves
+# an invalid index behind, which has to be dropped for it to be built again
+INDEXES = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_image_content_hash ON image (content_hash)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_image_user_created ON image (user_id, created_at, image_id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_image_from_image_id ON image (from_image_id)",
+]
+
+
+def enum_types() -> dict:
+    """Named enum types of the schema and their values"""
+    return {column.type.name: column.type.enums
+            for table in Base.metadata.tables.values()
+            for column in table.columns
+            if isinstance(column.type, Enum) and column.type.name}
+
+
+async def migrate():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    if engine.dialect.name != "postgresql":
+        return
+    # Neither enum values (before Postgres 12) nor indexes built concurrently
+    # can be added within a transaction
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for name, values in enum_types().items():
+            for value in values:
+                await conn.execute(text(f"ALTER TYPE {name} ADD VALUE IF NOT EXISTS '{value}'"))
+        for statement in UPGRADES + INDEXES:
+            await conn.execute(text(statement))
+
+
+async def main():
+    started = perf_counter()
+    try:
+        await migrate()
+    finally:
+        await engine.dispose()
+    print(f"Schema is up to date ({perf_counter() - started:.2f}s)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
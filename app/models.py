@@ -1,22 +1,98 @@
-from sqlalchemy import Column, String, Enum, ForeignKey, DateTime, Integer
+from sqlalchemy import Column, String, Enum, ForeignKey, DateTime, Float, Integer, Index, func
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship, mapped_column, deferred
 from sqlalchemy.dialects.postgresql import UUID
 from .database import Base
 import uuid
 
+ModelTypeEnum = Enum('internal', '24ai', 'auto', name='model_type')
+OperationTypeEnum = Enum('background_remove', 'super_resolution', name='operation_type')
+
 class Image(Base):
     __tablename__ = "image"
     imageId = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, name='image_id')
     type = Column(Enum('original', 'background_remove', 'super_resolution', name='image_type'))
-    modelType = Column(Enum('internal', '24ai', name='model_type'), name='model_type')
+    modelType = Column(ModelTypeEnum, name='model_type')
     createdAt = Column(DateTime(timezone=True), name='created_at')
     uploadedAt = deferred(Column(DateTime(timezone=True), name='uploaded_at'))
     transformedAt = deferred(Column(DateTime(timezone=True), name='transformed_at'))
     sizeBytes = deferred(Column(Integer, name='size_bytes'))
     mimeType = Column(String, name='mime_type')
+    etag = deferred(Column(String, name='etag'))
+    # sha256 hex of the content
+    contentHash = deferred(Column(String, name='content_hash', index=True))
+    # Image whose stored object has the same content, if this one has none of its own
+    objectId = Column(UUID(as_uuid=True), name='object_id')
     userId = deferred(Column(String, name='user_id'))
-    fromImageId = mapped_column(UUID(as_uuid=True), ForeignKey('image.image_id'), name='from_image_id')
+    fromImageId = mapped_column(UUID(as_uuid=True), ForeignKey('image.image_id'), name='from_image_id', index=True)
     status = Column(Enum('processing', 'ready', 'error', name='image_status'))
 
-    children = relationship("Image", back_populates="parent", remote_side=[fromImageId], lazy="joined")
+    # ID the stored object is kept under, selectable as a column too
+    @hybrid_property
+    def storageId(self) -> uuid.UUID:
+        return self.objectId or self.imageId
+
+    @storageId.inplace.expression
+    @classmethod
+    def _storage_id_expression(cls):
+        return func.coalesce(cls.objectId, cls.imageId)
+
+    # Never loaded implicitly, trees are read with crud.get_image_tree
+    children = relationship("Image", back_populates="parent", remote_side=[fromImageId], lazy="raise")
     parent = relationship("Image", back_populates="children", remote_side=[imageId])
+
+    __table_args__ = (
+        # User's listing, newest first, paginated by (created_at, image_id)
+        Index('ix_image_user_created', 'user_id', 'created_at', 'image_id'),
+    )
+
+
+class TransformJob(Base):
+    """
+    Durable transform queue, claimed by workers (app/worker.py) with
+    SELECT ... FOR UPDATE SKIP LOCKED. Running jobs hold a lease, which
+    workers extend while alive, expired ones are re-queued
+    """
+    __tablename__ = "transform_job"
+    jobId = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, name='job_id')
+    imageId = mapped_column(UUID(as_uuid=True), ForeignKey('image.image_id'), name='image_id')
+    fromImageId = mapped_column(UUID(as_uuid=True), ForeignKey('image.image_id'), name='from_image_id')
+    extension = Column(String)
+    operationType = Column(OperationTypeEnum, name='operation_type')
+    modelType = Column(ModelTypeEnum, name='model_type')
+    status = Column(Enum('queued', 'running', 'done', 'failed', name='job_status'), default='queued')
+    attempts = Column(Integer, default=0)
+    workerId = Column(String, name='worker_id')
+    leaseExpiresAt = Column(DateTime(timezone=True), name='lease_expires_at')
+    createdAt = Column(DateTime(timezone=True), name='created_at')
+
+    __table_args__ = (
+        Index('ix_transform_job_claim', 'status', 'model_type', 'created_at'),
+    )
+
+
+class TransformCache(Base):
+    """
+    Result of an operation over a given content, reused by later requests
+    for the same content, operation and model instead of calling ML again
+    """
+    __tablename__ = "transform_cache"
+    contentHash = Column(String, primary_key=True, name='content_hash')
+    operationType = Column(OperationTypeEnum, primary_key=True, name='operation_type')
+    modelType = Column(ModelTypeEnum, primary_key=True, name='model_type')
+    imageId = mapped_column(UUID(as_uuid=True), ForeignKey('image.image_id'), name='image_id')
+    hits = Column(Integer, default=0)
+    createdAt = Column(DateTime(timezone=True), name='created_at')
+    lastHitAt = Column(DateTime(timezone=True), name='last_hit_at', index=True)
+
+
+class RateLimitBucket(Base):
+    """
+    Token bucket of a per-user rate limit (app/ratelimit.py), for limits shared
+    by API replicas. Tokens are as of updatedAt, refilled on the next take
+    """
+    __tablename__ = "rate_limit_bucket"
+    # `{limit}:{userId}`
+    key = Column(String, primary_key=True)
+    tokens = Column(Float)
+    updatedAt = Column(DateTime(timezone=True), name='updated_at')
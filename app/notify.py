@@ -0,0 +1,123 @@
+"""
+Image status changes over Postgres LISTEN/NOTIFY. Status updates publish
+to STATUS_CHANNEL in their transaction (see crud.update_image), each API
+process keeps one listening connection and fans events out to subscribers
+"""
+import asyncio
+import json
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, Set
+from uuid import UUID
+
+import asyncpg
+from sqlalchemy.engine import make_url
+
+from .config import ASYNC_DATABASE_URL, NOTIFY_RECONNECT_SECONDS
+from .status_cache import status_cache
+
+STATUS_CHANNEL = "image_status"
+
+# Put to subscriber queues when events may have been missed, e.g. on reconnect
+RESYNC = None
+
+
+def status_payload(image_id: UUID, user_id: str, status: str) -> str:
+    return json.dumps({"imageId": str(image_id), "userId": user_id, "status": status})
+
+
+class StatusHub:
+    def __init__(self, url: str):
+        # Plain asyncpg DSN, without the SQLAlchemy driver part
+        self.dsn = make_url(url).set(drivername="postgresql").render_as_string(hide_password=False)
+        self.subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._connection: Optional[asyncpg.Connection] = None
+
+        self.connected = False
+        self.reconnects_total = 0
+        self.events_total = 0
+        self.delivered_total = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    async def _listen(self):
+        while True:
+            lost = asyncio.Event()
+            try:
+                self._connection = await asyncpg.connect(self.dsn)
+                self._connection.add_termination_listener(lambda _: lost.set())
+                await self._connection.add_listener(STATUS_CHANNEL, self._on_notify)
+                self.connected = True
+                print(f"Listening to {STATUS_CHANNEL}")
+                if self.reconnects_total:
+                    self.resync()
+                await lost.wait()
+            except asyncio.CancelledError:
+                if self._connection is not None and not self._connection.is_closed():
+                    await self._connection.close()
+                raise
+            except Exception as e:
+                print(f"Status listener error: {e} ({type(e)})")
+            finally:
+                self.connected = False
+                self._connection = None
+
+            # Events sent while disconnected are lost, subscribers re-read on resync
+            self.reconnects_total += 1
+            await asyncio.sleep(NOTIFY_RECONNECT_SECONDS)
+
+    def _on_notify(self, connection, pid, channel, payload: str):
+        self.dispatch(json.loads(payload))
+
+    def dispatch(self, event: dict):
+        self.events_total += 1
+        status_cache.invalidate(UUID(event["imageId"]))
+        for queue in self.subscribers.get(event["imageId"], ()):
+            queue.put_nowait(event)
+            self.delivered_total += 1
+
+    def resync(self):
+        status_cache.clear()
+        for queue in {queue for queues in self.subscribers.values() for queue in queues}:
+            queue.put_nowait(RESYNC)
+
+    @contextmanager
+    def subscribe(self, image_ids: Iterable[UUID]) -> Iterator[asyncio.Queue]:
+        """Queue receiving status events of given images, RESYNC if some could be missed"""
+        queue = asyncio.Queue()
+        keys = {str(image_id) for image_id in image_ids}
+        for key in keys:
+            self.subscribers.setdefault(key, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            for key in keys:
+                queues = self.subscribers.get(key)
+                if queues is not None:
+                    queues.discard(queue)
+                    if not queues:
+                        del self.subscribers[key]
+
+    def stats(self) -> dict:
+        return {
+            "connected": self.connected,
+            "watchedImages": len(self.subscribers),
+            "subscribers": len({queue for queues in self.subscribers.values() for queue in queues}),
+            "reconnectsTotal": self.reconnects_total,
+            "eventsTotal": self.events_total,
+            "deliveredTotal": self.delivered_total,
+        }
+
+
+status_hub = StatusHub(ASYNC_DATABASE_URL)
@@ -0,0 +1,278 @@
+"""
+Local disk cache of recently read and written S3 objects, per process,
+keyed by image ID and ETag. Objects are never rewritten under the same key,
+so an entry stays valid until evicted, least recently used first, once
+OBJECT_CACHE_MAX_BYTES is exceeded. Entries are read memory-mapped.
+Concurrent whole reads of one object share a single fetch. Fills streamed
+along with a client's read go as fast as that client, so nobody waits for
+them: other readers go to S3 meanwhile
+"""
+import asyncio
+import mmap
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from typing import Awaitable, BinaryIO, Callable, Dict, Optional, Set, Tuple
+from uuid import uuid4
+
+from .config import OBJECT_CACHE_DIR, OBJECT_CACHE_MAX_BYTES
+from .metrics import OBJECT_CACHE_BYTES, OBJECT_CACHE_EVICTIONS_TOTAL, OBJECT_CACHE_REQUESTS_TOTAL
+
+
+def _write_file(path: str, data: bytes) -> None:
+    with open(path, "wb") as file:
+        file.write(data)
+
+
+def _discard_file(file: Optional[BinaryIO], path: str) -> None:
+    if file is not None:
+        file.close()
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class CacheFill:
+    """
+    Object written into the cache chunk by chunk, as it's streamed elsewhere.
+    Each chunk goes to a temp file off the event loop, nothing is held in
+    memory, and the file is taken in on commit
+    """
+
+    def __init__(self, cache: "ObjectCache", key: str):
+        self.cache = cache
+        self.key = key
+        self.size = 0
+        self.path = cache._temp_path(key)
+        self.file: Optional[BinaryIO] = None
+        self.over = False
+        # Write running in a thread, if any, the file is left alone until it's over
+        self._writing: Optional[asyncio.Future] = None
+
+    def _write(self, chunk: bytes) -> bool:
+        try:
+            if self.file is None:
+                self.file = open(self.path, "wb")
+            self.file.write(chunk)
+            return True
+        except OSError as e:
+            print(f"Object cache write failed: {e} ({type(e)})")
+            return False
+
+    def _close(self):
+        self.file.close()
+
+    async def write(self, chunk: bytes):
+        if self.over:
+            return
+        self.size += len(chunk)
+        if self.size > self.cache.max_bytes:
+            # Wouldn't fit anyway
+            self.abort()
+            return
+        # Shielded, so a cancelled caller doesn't leave the thread writing to a file being discarded
+        self._writing = asyncio.ensure_future(asyncio.to_thread(self._write, chunk))
+        if not await asyncio.shield(self._writing):
+            self.abort()
+
+    async def commit(self, etag: str):
+        if self.over:
+            return
+        if not self.size:
+            self.abort()
+            return
+        self.over = True
+        try:
+            await asyncio.to_thread(self._close)
+            self.cache._add(self.key, etag, self.path, self.size)
+        except BaseException:
+            asyncio.get_running_loop().run_in_executor(None, _discard_file, None, self.path)
+            raise
+        finally:
+            self.cache._filled(self.key)
+
+    def abort(self):
+        if self.over:
+            return
+        self.over = True
+        self.cache._filled(self.key)
+
+        loop = asyncio.get_running_loop()
+
+        def discard(_=None):
+            loop.run_in_executor(None, _discard_file, self.file, self.path)
+
+        if self._writing is not None and not self._writing.done():
+            self._writing.add_done_callback(discard)
+        else:
+            discard()
+
+
+class ObjectCache:
+    def __init__(self, max_bytes: int, directory: str):
+        self.max_bytes = max_bytes
+        self.directory = directory or None
+        self._root: Optional[str] = None
+        # imageId -> (ETag, size), least recently used first
+        self._entries: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        # Keys being filled as streamed, and fetched whole by `get`, with their waiters
+        self._filling: Set[str] = set()
+        self._fetching: Dict[str, asyncio.Future] = {}
+
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.fills = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @property
+    def root(self) -> str:
+        """Directory of this process, made on first use"""
+        if self._root is None:
+            self._root = tempfile.mkdtemp(prefix="object-cache-", dir=self.directory)
+        return self._root
+
+    def _path(self, key: str, etag: str) -> str:
+        # ETags are quoted, multipart ones end with -<parts>
+        etag = etag.strip('"').replace("/", "_")
+        return os.path.join(self.root, f"{key}.{etag}")
+
+    def _temp_path(self, key: str) -> str:
+        """Path of its own for a file being written, taken in by `_add` once complete"""
+        return os.path.join(self.root, f"{key}.{uuid4().hex}.tmp")
+
+    def size(self, key: str) -> Optional[int]:
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None else None
+
+    def open(self, key: str, etag: Optional[str] = None) -> Optional[Tuple[mmap.mmap, str]]:
+        """Mapped object and its ETag, None if it's not cached, or cached with another `etag`"""
+        entry = self._entries.get(key)
+        if entry is None or (etag is not None and entry[0] != etag):
+            return None
+        self._entries.move_to_end(key)
+
+        cached_etag, _ = entry
+        with open(self._path(key, cached_etag), "rb") as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ), cached_etag
+
+    def lookup(self, key: str, etag: Optional[str] = None) -> Optional[Tuple[mmap.mmap, str]]:
+        """Same as `open`, counted as a hit or a miss"""
+        if not self.enabled:
+            return None
+        cached = self.open(key, etag)
+        self._count(cached is not None)
+        return cached
+
+    async def get(self, key: str, etag: Optional[str], fetch: Callable[[], Awaitable[Tuple[bytes, str]]]) -> bytes:
+        """
+        Cached object, or what `fetch` returns as (data, ETag), stored for
+        later reads. Concurrent misses wait for the first one's fetch
+        """
+        if not self.enabled:
+            data, _ = await fetch()
+            return data
+
+        while key in self._fetching:
+            await asyncio.wait([self._fetching[key]])
+        cached = self.open(key, etag)
+        self._count(cached is not None)
+        if cached is not None:
+            with cached[0] as mapped:
+                return mapped[:]
+
+        if key in self._fetching:
+            # Another fetch got in since, its waiters keep waiting for it
+            data, _ = await fetch()
+            return data
+        self._fetching[key] = asyncio.get_running_loop().create_future()
+        try:
+            data, fetched_etag = await fetch()
+            await self.put(key, fetched_etag, data)
+            return data
+        finally:
+            self._fetching.pop(key).set_result(None)
+
+    async def put(self, key: str, etag: str, data: bytes):
+        # Empty files can't be mapped, nor are they valid images
+        if not self.enabled or not 0 < len(data) <= self.max_bytes:
+            return
+        path = self._temp_path(key)
+        await asyncio.to_thread(_write_file, path, data)
+        self._add(key, etag, path, len(data))
+
+    def begin_fill(self, key: str) -> Optional[CacheFill]:
+        """Fill of `key` written as it streams, None if disabled or it's being filled already"""
+        if not self.enabled or key in self._filling or key in self._fetching:
+            return None
+        self._filling.add(key)
+        return CacheFill(self, key)
+
+    def discard(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._remove(key, *entry)
+
+    def _count(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        OBJECT_CACHE_REQUESTS_TOTAL.labels("hit" if hit else "miss").inc()
+
+    def _filled(self, key: str):
+        self._filling.discard(key)
+
+    def _add(self, key: str, etag: str, written: str, size: int):
+        """Takes in a `written` file, evicting least recently used entries beyond the size limit"""
+        self.discard(key)
+        os.replace(written, self._path(key, etag))
+        self._entries[key] = (etag, size)
+        self.size_bytes += size
+        self.fills += 1
+
+        while self.size_bytes > self.max_bytes:
+            evicted, entry = self._entries.popitem(last=False)
+            self._remove(evicted, *entry)
+            self.evictions += 1
+            OBJECT_CACHE_EVICTIONS_TOTAL.inc()
+        OBJECT_CACHE_BYTES.set(self.size_bytes)
+
+    def _remove(self, key: str, etag: str, size: int):
+        # Open maps of it stay readable
+        try:
+            os.unlink(self._path(key, etag))
+        except FileNotFoundError:
+            pass
+        self.size_bytes -= size
+        OBJECT_CACHE_BYTES.set(self.size_bytes)
+
+    def close(self):
+        if self._root is not None:
+            shutil.rmtree(self._root, ignore_errors=True)
+        self._root = None
+        self._entries.clear()
+        self.size_bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "maxBytes": self.max_bytes,
+            "sizeBytes": self.size_bytes,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "fills": self.fills,
+            "evictions": self.evictions,
+        }
+
+
+object_cache = ObjectCache(OBJECT_CACHE_MAX_BYTES, OBJECT_CACHE_DIR)
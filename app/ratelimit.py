@@ -0,0 +1,123 @@
+"""
+Per-user rate limits as token buckets, refilled continuously at `rate` per
+second up to `burst`. Buckets live in process memory, or in Postgres when
+limits must hold across API replicas. Requests over a limit are answered
+with 429 and Retry-After by the RateLimitExceeded handler
+"""
+from collections import OrderedDict
+from time import monotonic
+from typing import Dict, Tuple
+
+from sqlalchemy import Float, cast, func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from .config import RATE_LIMIT_BACKEND, RATE_LIMIT_MAX_BUCKETS, RATE_LIMIT_REQUESTS_BURST, \
+    RATE_LIMIT_REQUESTS_PER_SECOND, RATE_LIMIT_UPLOAD_BURST_BYTES, RATE_LIMIT_UPLOAD_BYTES_PER_SECOND
+from .database import SessionLocal
+from .metrics import RATE_LIMITED_TOTAL
+from .models import RateLimitBucket
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, limit: str, retry_after: float):
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+class MemoryBuckets:
+    """Buckets of this process, least recently used ones beyond `size` are dropped and start over full"""
+
+    def __init__(self, size: int):
+        self.size = size
+        # key -> (tokens, refilled at)
+        self.buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def take(self, key: str, cost: float, rate: float, burst: float, force: bool = False) -> float:
+        now = monotonic()
+        tokens, refilled_at = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - refilled_at) * rate)
+
+        granted = force or tokens >= cost
+        if granted:
+            tokens -= cost
+        self.buckets[key] = (tokens, now)
+        self.buckets.move_to_end(key)
+        while len(self.buckets) > self.size:
+            self.buckets.popitem(last=False)
+
+        return 0.0 if granted else (cost - tokens) / rate
+
+
+class PostgresBuckets:
+    """
+    Buckets in the rate_limit_bucket table, shared by all processes. A grant
+    is a single upsert, refilled from the row's age by the database clock,
+    which doesn't touch the row unless tokens suffice
+    """
+
+    async def take(self, key: str, cost: float, rate: float, burst: float, force: bool = False) -> float:
+        refilled = func.least(
+            burst,
+            RateLimitBucket.tokens + cast(func.extract("epoch", func.now() - RateLimitBucket.updatedAt), Float) * rate)
+
+        upsert = insert(RateLimitBucket).values(key=key, tokens=burst - cost, updatedAt=func.now())
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[RateLimitBucket.key],
+            set_={"tokens": refilled - cost, "updated_at": func.now()},
+            where=None if force else refilled >= cost,
+        ).returning(RateLimitBucket.tokens)
+
+        async with SessionLocal() as db:
+            granted = (await db.execute(upsert)).first() is not None
+            if granted:
+                await db.commit()
+                return 0.0
+            # Denied, the row is as it was
+            tokens = await db.scalar(select(refilled).where(RateLimitBucket.key == key))
+        return (cost - tokens) / rate
+
+
+class RateLimiter:
+    def __init__(self, buckets, limits: Dict[str, Tuple[float, float]]):
+        self.buckets = buckets
+        # Limit name -> (rate, burst), 0 rate disables it
+        self.limits = limits
+
+        self.allowed_total = {limit: 0 for limit in limits}
+        self.limited_total = {limit: 0 for limit in limits}
+
+    async def check(self, limit: str, user_id: str, cost: float = 1, force: bool = False):
+        """
+        Takes `cost` from user's `limit` bucket or raises RateLimitExceeded.
+        Cost beyond burst is capped to it, so it passes once the bucket is full.
+        Forced cost is taken even if it runs the bucket into debt, for costs
+        only known after the fact, which later requests wait out
+        """
+        rate, burst = self.limits[limit]
+        if rate <= 0:
+            return
+
+        retry_after = await self.buckets.take(f"{limit}:{user_id}", min(cost, burst), rate, burst, force)
+        if retry_after > 0:
+            self.limited_total[limit] += 1
+            RATE_LIMITED_TOTAL.labels(limit).inc()
+            raise RateLimitExceeded(limit, retry_after)
+        self.allowed_total[limit] += 1
+
+    def stats(self) -> dict:
+        return {
+            "backend": RATE_LIMIT_BACKEND,
+            "limits": {
+                limit: {"rate": rate, "burst": burst, "allowed": self.allowed_total[limit],
+                        "limited": self.limited_total[limit]}
+                for limit, (rate, burst) in self.limits.items()
+            },
+        }
+
+
+rate_limiter = RateLimiter(
+    PostgresBuckets() if RATE_LIMIT_BACKEND == "postgres" else MemoryBuckets(RATE_LIMIT_MAX_BUCKETS),
+    {
+        "requests": (RATE_LIMIT_REQUESTS_PER_SECOND, RATE_LIMIT_REQUESTS_BURST),
+        "upload_bytes": (RATE_LIMIT_UPLOAD_BYTES_PER_SECOND, RATE_LIMIT_UPLOAD_BURST_BYTES),
+    })
@@ -0,0 +1,112 @@
+from asyncio import Lock, Semaphore
+from contextlib import AsyncExitStack, asynccontextmanager
+from time import monotonic
+from typing import AsyncIterator
+
+import aioboto3
+from aiobotocore.config import AioConfig
+
+from .config import AWS_ACCESS_KEY_ID, AWS_REGION, AWS_SECRET_ACCESS_KEY, S3_BUCKET, S3_ENDPOINT_URL, IMAGE_DIR, \
+    S3_MAX_POOL_CONNECTIONS, S3_PRESIGN_EXPIRES_SECONDS, S3_PUBLIC_ENDPOINT_URL
+
+
+def object_key(uuid, extension: str) -> str:
+    return f"/{IMAGE_DIR}/{uuid}.{extension}"
+
+
+class S3Pool:
+    """
+    Single long-lived async S3 client for the whole process, started on app
+    startup and closed on shutdown. Callers borrow it with `acquire()`, which
+    is bounded by the connection pool size, so waiting there means the pool
+    is saturated
+    """
+
+    def __init__(self, max_connections: int):
+        self.max_connections = max_connections
+        self._session = aioboto3.Session(
+            aws_access_key_id=AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+            region_name=AWS_REGION,
+        )
+        self._semaphore = Semaphore(max_connections)
+        self._start_lock = Lock()
+        self._stack = None
+        self._client = None
+        self._presigner = None
+
+        self.in_use = 0
+        self.waiting = 0
+        self.peak_in_use = 0
+        self.acquired_total = 0
+        self.saturated_total = 0
+        self.wait_seconds_total = 0.0
+
+    async def start(self):
+        async with self._start_lock:
+            if self._client is not None:
+                return
+            self._stack = AsyncExitStack()
+            self._client = await self._stack.enter_async_context(self._session.client(
+                "s3",
+                endpoint_url=S3_ENDPOINT_URL,
+                config=AioConfig(max_pool_connections=self.max_connections)))
+            # Signs URLs for clients, for the host they reach S3 at, never connects itself
+            self._presigner = await self._stack.enter_async_context(self._session.client(
+                "s3",
+                endpoint_url=S3_PUBLIC_ENDPOINT_URL,
+                config=AioConfig(signature_version="s3v4", s3={"addressing_style": "path"})))
+
+    async def close(self):
+        if self._stack is not None:
+            await self._stack.aclose()
+        self._stack = None
+        self._client = None
+        self._presigner = None
+
+    async def presign(self, method: str, params: dict, expires_in: int = S3_PRESIGN_EXPIRES_SECONDS) -> str:
+        """URL to call `method` ("put_object", "get_object") with `params` without credentials, Bucket is added"""
+        if self._presigner is None:
+            await self.start()
+        return await self._presigner.generate_presigned_url(
+            method, Params={"Bucket": S3_BUCKET, **params}, ExpiresIn=expires_in)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator:
+        # Started lazily as well, for code running outside of the app lifecycle
+        if self._client is None:
+            await self.start()
+
+        if self._semaphore.locked():
+            self.saturated_total += 1
+
+        self.waiting += 1
+        started = monotonic()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+            self.wait_seconds_total += monotonic() - started
+
+        self.in_use += 1
+        self.acquired_total += 1
+        self.peak_in_use = max(self.peak_in_use, self.in_use)
+        try:
+            yield self._client
+        finally:
+            self.in_use -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "maxConnections": self.max_connections,
+            "inUse": self.in_use,
+            "waiting": self.waiting,
+            "peakInUse": self.peak_in_use,
+            "acquiredTotal": self.acquired_total,
+            "saturatedTotal": self.saturated_total,
+            "waitSecondsTotal": round(self.wait_seconds_total, 3),
+        }
+
+
+s3_pool = S3Pool(S3_MAX_POOL_CONNECTIONS)
@@ -1,13 +1,20 @@
-from pydantic import BaseModel, UUID4
+from pydantic import BaseModel, UUID4, conint, conlist
 from typing import Optional
 from datetime import datetime
 from enum import Enum
 
+from .config import BATCH_MAX_CHILDREN, STATUS_BATCH_MAX_IMAGES
+
 class ImageStatus(str, Enum):
     processing = "processing"
     ready = "ready"
     error = "error"
 
+class ImageType(str, Enum):
+    original = "original"
+    background_remove = "background_remove"
+    super_resolution = "super_resolution"
+
 class OperationType(str, Enum):
     background_remove = "background_remove"
     super_resolution = "super_resolution"
@@ -15,6 +22,8 @@ class OperationType(str, Enum):
 class ModelType(str, Enum):
     internal = "internal"
     ai24 = "24ai"
+    # Picked per transform by latency, background removal only
+    auto = "auto"
 
 class ImageBase(BaseModel):
     imageId: UUID4
@@ -41,7 +50,41 @@ class CreateChildImage(BaseModel):
     modelType: Optional[ModelType] = ModelType.internal
 
 
+class CreateChildImages(BaseModel):
+    children: conlist(CreateChildImage, min_items=1, max_items=BATCH_MAX_CHILDREN)
+
+
+class ImageStatusQuery(BaseModel):
+    imageIds: conlist(UUID4, min_items=1, max_items=STATUS_BATCH_MAX_IMAGES)
+
+
 class CreateImage(BaseModel):
     operationType: Optional[OperationType]
     modelType: Optional[ModelType] = ModelType.internal
     image: str
+
+
+class UploadMimeType(str, Enum):
+    jpeg = "image/jpeg"
+    png = "image/png"
+
+
+class CreatePresignedImage(BaseModel):
+    operationType: Optional[OperationType]
+    modelType: Optional[ModelType] = ModelType.internal
+    mimeType: UploadMimeType
+    sizeBytes: conint(gt=0)
+
+
+class PresignedUpload(BaseModel):
+    image: Image
+    uploadUrl: str
+    # To be sent with the PUT, they're signed
+    uploadHeaders: dict
+    expiresIn: int
+
+
+class PresignedDownload(BaseModel):
+    url: str
+    mimeType: str
+    expiresIn: int
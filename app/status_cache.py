@@ -0,0 +1,79 @@
+"""
+Recently read image statuses, in-process. Entries are dropped on status
+writes (crud.update_image) and on status notifications, so writes of other
+processes reach the cache as well, TTLs bound staleness if some are missed
+"""
+from collections import OrderedDict
+from time import monotonic
+from typing import Dict, List, Tuple
+from uuid import UUID
+
+from .config import STATUS_CACHE_SIZE, STATUS_CACHE_TERMINAL_TTL_SECONDS, STATUS_CACHE_TTL_SECONDS
+
+TERMINAL_STATUSES = ("ready", "error")
+
+
+class StatusCache:
+    def __init__(self, size: int, ttl: float, terminal_ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.terminal_ttl = terminal_ttl
+        # imageId -> (userId, status, expires at), least recently used first
+        self.entries: "OrderedDict[UUID, Tuple[str, str, float]]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get_many(self, image_ids: List[UUID], user_id: str) -> Tuple[Dict[UUID, str], List[UUID]]:
+        """Cached statuses of user's images, and images to be read"""
+        found = {}
+        missing = []
+        now = monotonic()
+        for image_id in image_ids:
+            entry = self.entries.get(image_id)
+            if entry is None or entry[2] < now:
+                missing.append(image_id)
+            elif entry[0] == user_id:
+                self.entries.move_to_end(image_id)
+                found[image_id] = entry[1]
+            # Someone else's image, not found as with a read
+        self.hits += len(image_ids) - len(missing)
+        self.misses += len(missing)
+        return found, missing
+
+    def put_many(self, user_id: str, statuses: Dict[UUID, str]):
+        if self.size <= 0:
+            return
+        now = monotonic()
+        for image_id, status in statuses.items():
+            ttl = self.terminal_ttl if status in TERMINAL_STATUSES else self.ttl
+            self.entries[image_id] = (user_id, status, now + ttl)
+            self.entries.move_to_end(image_id)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, image_id: UUID):
+        if self.entries.pop(image_id, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxSize": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+        }
+
+
+status_cache = StatusCache(STATUS_CACHE_SIZE, STATUS_CACHE_TTL_SECONDS, STATUS_CACHE_TERMINAL_TTL_SECONDS)
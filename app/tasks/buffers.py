@@ -0,0 +1,98 @@
+"""
+Process-wide memory budget of transforms. Each transform reserves the bytes
+it expects to hold, parent image, encoded bodies and results, before fetching
+anything, and waits its turn in arrival order while the budget is taken
+"""
+import asyncio
+from collections import deque
+from time import monotonic
+from typing import Deque, Tuple
+
+from ..config import TRANSFORM_MEMORY_BUDGET_BYTES
+
+
+class BufferManager:
+    """
+    Byte budget handed out first come, first served: a large reservation at
+    the head of the queue isn't overtaken by smaller ones behind it.
+    Reservations larger than the whole budget are cut down to it, so they
+    run alone instead of never
+    """
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+
+        self.reserved = 0
+        self.peak_reserved = 0
+        self.acquired_total = 0
+        self.queued_total = 0
+        self.oversized_total = 0
+        self.wait_seconds_total = 0.0
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, nbytes: int) -> int:
+        """Waits until `nbytes` fit in the budget, returns bytes reserved, to be released"""
+        if nbytes > self.budget_bytes:
+            self.oversized_total += 1
+            nbytes = self.budget_bytes
+
+        if self._waiters or self.reserved + nbytes > self.budget_bytes:
+            self.queued_total += 1
+            future = asyncio.get_running_loop().create_future()
+            waiter = (nbytes, future)
+            self._waiters.append(waiter)
+            started = monotonic()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # Granted just before being cancelled
+                    self.release(nbytes)
+                elif waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    # Ones queued behind may fit now
+                    self._wake()
+                raise
+            finally:
+                self.wait_seconds_total += monotonic() - started
+        else:
+            self._take(nbytes)
+
+        self.acquired_total += 1
+        return nbytes
+
+    def release(self, nbytes: int):
+        self.reserved -= nbytes
+        self._wake()
+
+    def _take(self, nbytes: int):
+        self.reserved += nbytes
+        self.peak_reserved = max(self.peak_reserved, self.reserved)
+
+    def _wake(self):
+        while self._waiters and self.reserved + self._waiters[0][0] <= self.budget_bytes:
+            nbytes, future = self._waiters.popleft()
+            if future.done():
+                # Cancelled, its task hasn't run yet to dequeue it
+                continue
+            self._take(nbytes)
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "budgetBytes": self.budget_bytes,
+            "reservedBytes": self.reserved,
+            "peakReservedBytes": self.peak_reserved,
+            "waiting": self.waiting,
+            "acquired": self.acquired_total,
+            "queued": self.queued_total,
+            "oversized": self.oversized_total,
+            "waitSecondsTotal": round(self.wait_seconds_total, 3),
+        }
+
+
+buffer_manager = BufferManager(TRANSFORM_MEMORY_BUDGET_BYTES)
@@ -0,0 +1,227 @@
+from binascii import a2b_base64
+from typing import Any, Callable, Tuple
+
+# Where ML backends put the resulting image in their responses
+PREDICTIONS_PATH = ("predictions",)
+AI24_IMAGE_PATH = ("data", "image")
+
+# JSON escapes that may show up inside a base64 string, whitespace is dropped
+_ESCAPES = {ord("/"): b"/", ord("\\"): b"\\", ord('"'): b'"',
+            ord("n"): b"", ord("r"): b"", ord("t"): b"", ord("b"): b"", ord("f"): b""}
+
+# Scanner states
+_STRUCTURE = 0
+_KEY = 1
+_SKIP_STRING = 2
+_VALUE = 3
+_DONE = 4
+
+
+class DecoderError(Exception):
+    pass
+
+
+class Base64JsonValueDecoder:
+    """
+    Incrementally extracts a base64 string value at `path` (keys of nested
+    objects) out of a JSON document fed in arbitrary chunks, and writes
+    decoded bytes to `write` as soon as whole base64 quanta are available.
+
+    Only the envelope around the value is scanned byte by byte, the value
+    itself is processed in bulk between escapes, and at most 3 leftover
+    base64 characters are carried between chunks
+    """
+
+    def __init__(self, path: Tuple[str, ...], write: Callable[[bytes], Any]):
+        self.path = tuple(path)
+        self.write = write
+
+        self._state = _STRUCTURE
+        # [name in parent, is object, expecting key] per open container
+        self._stack = []
+        self._key = bytearray()
+        self._escape = False
+        # Collected hex digits of a \uXXXX escape, None when not in one
+        self._unicode = None
+        self._tail = b""
+        self.decoded_bytes = 0
+
+    @property
+    def found(self) -> bool:
+        return self._state == _DONE
+
+    def feed(self, chunk: bytes):
+        data = memoryview(chunk)
+        pos = 0
+        size = len(data)
+
+        while pos < size:
+            if self._state == _VALUE:
+                pos = self._feed_value(chunk, data, pos)
+            elif self._state == _STRUCTURE:
+                pos = self._feed_structure(data, pos)
+            elif self._state == _DONE:
+                return
+            else:
+                pos = self._feed_string(chunk, data, pos)
+
+    def close(self):
+        if self._state != _DONE:
+            raise DecoderError(f"Value at {'.'.join(self.path)} not found or truncated")
+
+    def _slot(self):
+        """Name of the slot the next value goes to: object key, `[]` for arrays"""
+        if not self._stack:
+            return None
+        if self._stack[-1][1]:
+            return self._key.decode("utf-8", "replace")
+        return "[]"
+
+    def _feed_structure(self, data: memoryview, pos: int) -> int:
+        char = data[pos]
+
+        if char == 0x7b:  # {
+            self._stack.append([self._slot(), True, True])
+        elif char == 0x5b:  # [
+            self._stack.append([self._slot(), False, False])
+        elif char in (0x7d, 0x5d):  # } ]
+            if self._stack:
+                self._stack.pop()
+        elif char == 0x2c:  # ,
+            if self._stack and self._stack[-1][1]:
+                self._stack[-1][2] = True
+        elif char == 0x22:  # "
+            if self._stack and self._stack[-1][1] and self._stack[-1][2]:
+                self._key.clear()
+                self._state = _KEY
+            elif tuple(frame[0] for frame in self._stack[1:]) + (self._slot(),) == self.path:
+                self._state = _VALUE
+            else:
+                self._state = _SKIP_STRING
+
+        return pos + 1
+
+    def _feed_string(self, chunk: bytes, data: memoryview, pos: int) -> int:
+        """Key or skipped value: look for the closing quote, honouring escapes"""
+        while pos < len(data):
+            if self._escape:
+                self._escape = False
+                if self._state == _KEY:
+                    self._key.append(data[pos])
+                pos += 1
+                continue
+
+            quote = chunk.find(b'"', pos)
+            backslash = chunk.find(b"\\", pos, quote if quote != -1 else len(chunk))
+
+            if backslash != -1:
+                if self._state == _KEY:
+                    self._key += data[pos:backslash]
+                self._escape = True
+                pos = backslash + 1
+                continue
+
+            if quote == -1:
+                if self._state == _KEY:
+                    self._key += data[pos:]
+                return len(data)
+
+            if self._state == _KEY:
+                self._key += data[pos:quote]
+                # Key read, the value follows
+                self._stack[-1][2] = False
+            self._state = _STRUCTURE
+            return quote + 1
+
+        return pos
+
+    def _feed_value(self, chunk: bytes, data: memoryview, pos: int) -> int:
+        """Target value: everything between escapes goes to base64 as is"""
+        while pos < len(data):
+            if self._unicode is not None:
+                pos = self._feed_unicode(data, pos)
+                continue
+
+            if self._escape:
+                self._escape = False
+                char = data[pos]
+                if char == 0x75:  # \uXXXX
+                    self._unicode = bytearray()
+                elif char in _ESCAPES:
+                    self._feed_base64(_ESCAPES[char])
+                else:
+                    raise DecoderError(f"Invalid escape \\{chr(char)}")
+                pos += 1
+                continue
+
+            quote = chunk.find(b'"', pos)
+            end = quote if quote != -1 else len(data)
+            backslash = chunk.find(b"\\", pos, end)
+
+            if backslash != -1:
+                # Fast path for escaped slashes only, as many JSON encoders emit
+                # them, otherwise escapes are handled one by one
+                unescaped = chunk[backslash:end].replace(b"\\/", b"/")
+                # Escape split by chunk boundary is finished with the next chunk
+                dangling = quote == -1 and unescaped.endswith(b"\\")
+                if dangling:
+                    unescaped = unescaped[:-1]
+
+                if b"\\" in unescaped:
+                    self._feed_base64(data[pos:backslash])
+                    self._escape = True
+                    pos = backslash + 1
+                    continue
+
+                self._feed_base64(data[pos:backslash])
+                self._feed_base64(unescaped)
+                self._escape = dangling
+            elif end > pos:
+                self._feed_base64(data[pos:end])
+
+            if quote == -1:
+                return len(data)
+
+            self._finish_value()
+            return quote + 1
+
+        return pos
+
+    def _feed_unicode(self, data: memoryview, pos: int) -> int:
+        take = min(4 - len(self._unicode), len(data) - pos)
+        self._unicode += data[pos:pos + take]
+        if len(self._unicode) == 4:
+            char = chr(int(self._unicode, 16))
+            self._unicode = None
+            if not char.isspace():
+                self._feed_base64(char.encode("ascii"))
+        return pos + take
+
+    def _feed_base64(self, data):
+        if self._tail:
+            need = 4 - len(self._tail)
+            self._tail += bytes(data[:need])
+            data = data[need:]
+            if len(self._tail) < 4:
+                return
+            self._write(a2b_base64(self._tail))
+            self._tail = b""
+
+        aligned = len(data) - len(data) % 4
+        if aligned:
+            self._write(a2b_base64(data[:aligned]))
+        if aligned != len(data):
+            self._tail = bytes(data[aligned:])
+
+    def _finish_value(self):
+        if self._tail:
+            if len(self._tail) == 1:
+                raise DecoderError("Truncated base64 value")
+            self._write(a2b_base64(self._tail + b"=" * (4 - len(self._tail))))
+            self._tail = b""
+        self._state = _DONE
+
+    def _write(self, decoded: bytes):
+        if decoded:
+            self.decoded_bytes += len(decoded)
+            self.write(decoded)
@@ -0,0 +1,78 @@
+import json
+from binascii import b2a_base64
+from typing import AsyncIterator, Callable
+
+
+class Base64JsonBody:
+    """
+    Request body for ML backends: `{"image": "<base64>", **fields}` produced
+    chunk by chunk from `source`, a factory of async byte iterators.
+
+    Every iteration calls `source` again, so the body can be replayed on
+    retries without ever holding the whole payload. Input is encoded in
+    3-byte aligned blocks, at most 2 bytes are carried between chunks
+    """
+
+    def __init__(self, source: Callable[[], AsyncIterator[bytes]], size: int, fields: dict, key: str = "image"):
+        self.source = source
+        self.size = size
+        self.prefix = json.dumps({key: ""})[:-2].encode()
+        rest = json.dumps(fields)
+        self.suffix = ('"' + (', ' + rest[1:] if fields else '}')).encode()
+
+    def __len__(self) -> int:
+        return len(self.prefix) + (self.size + 2) // 3 * 4 + len(self.suffix)
+
+    @property
+    def headers(self) -> dict:
+        return {"content-length": str(len(self))}
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        yield self.prefix
+
+        carry = b""
+        async for chunk in self.source():
+            data = memoryview(chunk)
+
+            if carry:
+                need = 3 - len(carry)
+                carry += bytes(data[:need])
+                data = data[need:]
+                if len(carry) < 3:
+                    continue
+                yield b2a_base64(carry, newline=False)
+                carry = b""
+
+            aligned = len(data) - len(data) % 3
+            if aligned:
+                yield b2a_base64(data[:aligned], newline=False)
+            if aligned != len(data):
+                carry = bytes(data[aligned:])
+
+        if carry:
+            yield b2a_base64(carry, newline=False)
+
+        yield self.suffix
+
+
+class EncodedJsonBody(Base64JsonBody):
+    """
+    Same body over image base64 encoded up front, so one encoding can be
+    shared by requests to several backends
+    """
+
+    def __init__(self, encoded: bytes, fields: dict, key: str = "image"):
+        super().__init__(None, 0, fields, key)
+        self.encoded = encoded
+
+    @staticmethod
+    def encode(image: bytes) -> bytes:
+        return b2a_base64(image, newline=False)
+
+    def __len__(self) -> int:
+        return len(self.prefix) + len(self.encoded) + len(self.suffix)
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        yield self.prefix
+        yield self.encoded
+        yield self.suffix
@@ -0,0 +1,184 @@
+import asyncio
+from contextlib import asynccontextmanager
+from time import monotonic
+from typing import AsyncIterator, Dict
+
+import httpx
+
+from ..config import ML_SSL_VERIFY, ML_INTERNAL_URL, ML_WORKSPACE_ID, ML_24AI_TOKEN, ML_24AI_URL, \
+    ML_HTTP2, ML_MAX_CONNECTIONS, ML_MAX_KEEPALIVE_CONNECTIONS, ML_CONNECT_TIMEOUT, ML_READ_TIMEOUT, \
+    ML_CIRCUIT_FAILURE_THRESHOLD, ML_CIRCUIT_RESET_SECONDS
+from ..schemas import ModelType
+
+
+class MLBackendError(Exception):
+    """Backend answered with an error status"""
+
+
+class CircuitOpenError(Exception):
+    """Backend is considered down, calls are rejected without trying"""
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures, then lets a single
+    probe call through every `reset_seconds` until one succeeds
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.probing or monotonic() - self.opened_at < self.reset_seconds:
+            return "open"
+        return "half_open"
+
+    def check(self):
+        state = self.state
+        if state == "open":
+            raise CircuitOpenError("Circuit is open")
+        if state == "half_open":
+            self.probing = True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            self.opened_at = monotonic()
+        self.probing = False
+
+    def record_cancelled(self):
+        """Call was given up on by the caller, tells nothing of the backend"""
+        self.probing = False
+
+
+class MLBackend:
+    """Long-lived keep-alive client for one ML backend, with its breaker and counters"""
+
+    def __init__(self, name: str, url: str, headers: Dict[str, str]):
+        self.name = name
+        self.url = url
+        self.headers = headers
+        self.breaker = CircuitBreaker(ML_CIRCUIT_FAILURE_THRESHOLD, ML_CIRCUIT_RESET_SECONDS)
+        self._client = None
+
+        self.in_flight = 0
+        self.requests_total = 0
+        self.errors_total = 0
+        self.rejected_total = 0
+        self.cancelled_total = 0
+        self.latency_seconds_total = 0.0
+        self.latency_seconds_max = 0.0
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                verify=ML_SSL_VERIFY,
+                http2=ML_HTTP2,
+                limits=httpx.Limits(
+                    max_connections=ML_MAX_CONNECTIONS,
+                    max_keepalive_connections=ML_MAX_KEEPALIVE_CONNECTIONS),
+                timeout=httpx.Timeout(ML_READ_TIMEOUT, connect=ML_CONNECT_TIMEOUT))
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+        self._client = None
+
+    async def warm(self):
+        """Opens a connection ahead of the first call, whatever the backend answers to a HEAD"""
+        await self.client.head(self.url)
+
+    @asynccontextmanager
+    async def stream(self, **kwargs) -> AsyncIterator[httpx.Response]:
+        """
+        POSTs to the backend, the call counts as failed for the breaker
+        if it raises or the response is an error, unless it's cancelled
+        """
+        try:
+            self.breaker.check()
+        except CircuitOpenError:
+            self.rejected_total += 1
+            raise
+
+        self.in_flight += 1
+        self.requests_total += 1
+        started = monotonic()
+        failed = True
+        cancelled = False
+        try:
+            headers = {**self.headers, **kwargs.pop("headers", {})}
+            async with self.client.stream("POST", url=self.url, headers=headers, **kwargs) as response:
+                if response.is_error:
+                    await response.aread()
+                    raise MLBackendError(f"{response.status_code}: {response.content[:512]}")
+                yield response
+            failed = False
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            elapsed = monotonic() - started
+            self.in_flight -= 1
+            self.latency_seconds_total += elapsed
+            self.latency_seconds_max = max(self.latency_seconds_max, elapsed)
+            if cancelled:
+                self.cancelled_total += 1
+                self.breaker.record_cancelled()
+            elif failed:
+                self.errors_total += 1
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+    def stats(self) -> dict:
+        return {
+            "circuit": self.breaker.state,
+            "inFlight": self.in_flight,
+            "requestsTotal": self.requests_total,
+            "errorsTotal": self.errors_total,
+            "rejectedTotal": self.rejected_total,
+            "cancelledTotal": self.cancelled_total,
+            "latencySecondsTotal": round(self.latency_seconds_total, 3),
+            "latencySecondsMax": round(self.latency_seconds_max, 3),
+        }
+
+
+class MLClients:
+    def __init__(self):
+        self.backends: Dict[ModelType, MLBackend] = {
+            ModelType.internal: MLBackend("internal", ML_INTERNAL_URL, {
+                "content-type": "application/json",
+                "x-workspace-id": ML_WORKSPACE_ID
+            }),
+            ModelType.ai24: MLBackend("24ai", ML_24AI_URL + 'remove-background', {
+                "content-type": "application/json",
+                "authorization": f"Token {ML_24AI_TOKEN}"
+            }),
+        }
+
+    def get(self, model: ModelType) -> MLBackend:
+        return self.backends[ModelType(model)]
+
+    async def close(self):
+        for backend in self.backends.values():
+            await backend.close()
+
+    def stats(self) -> dict:
+        return {backend.name: backend.stats() for backend in self.backends.values()}
+
+
+ml_clients = MLClients()
@@ -0,0 +1,195 @@
+"""
+Routing of `auto` transforms between the ML backends able to do them. Each
+call goes to the healthy backend with the lowest recent latency, scaled up
+by its recent error rate. Once it takes longer than the backend's usual
+(ML_AUTO_HEDGE_PERCENTILE of its latency), a hedged duplicate goes to the
+next backend, the first to finish wins and the other one is cancelled
+"""
+import asyncio
+from collections import deque
+from time import monotonic
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+from ..config import ML_AUTO_HEDGE_DEFAULT_SECONDS, ML_AUTO_HEDGE_MIN_SECONDS, ML_AUTO_HEDGE_PERCENTILE, \
+    ML_AUTO_LATENCY_WINDOW
+from ..metrics import ML_AUTO_ROUTED_TOTAL, ML_HEDGES_TOTAL
+from ..schemas import ModelType
+from .ml_client import CircuitOpenError, MLClients, ml_clients
+
+# Backends doing background removal, in order of preference while there's nothing to go by
+AUTO_MODELS = (ModelType.internal, ModelType.ai24)
+
+# Latency percentiles of a backend are trusted from that many calls on
+MIN_SAMPLES = 10
+
+T = TypeVar("T")
+
+
+class LatencyEstimate:
+    """Outcomes of the latest `window` calls to one backend"""
+
+    def __init__(self, window: int):
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.failures: Deque[bool] = deque(maxlen=window)
+
+    def record(self, seconds: Optional[float], failed: bool = False):
+        """Seconds a call took, if it got that far, failed ones only count into the error rate"""
+        if seconds is not None and not failed:
+            self.latencies.append(seconds)
+        self.failures.append(failed)
+
+    def record_censored(self, seconds: float):
+        """
+        Call given up on after `seconds`, it'd have taken longer. Kept only
+        if above the median, so it can raise the estimate, never lower it
+        """
+        median = self.percentile(0.5)
+        if median is None or seconds > median:
+            self.record(seconds)
+
+    @property
+    def error_rate(self) -> float:
+        return sum(self.failures) / len(self.failures) if self.failures else 0.0
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+    def score(self) -> float:
+        """Expected seconds per successful call, backends not called yet come first"""
+        median = self.percentile(0.5) or 0.0
+        return median / max(1 - self.error_rate, 0.05)
+
+
+class MLRouter:
+    def __init__(self, clients: MLClients, models: Tuple[ModelType, ...], window: int):
+        self.clients = clients
+        self.estimates: Dict[ModelType, LatencyEstimate] = {model: LatencyEstimate(window) for model in models}
+
+        self.routed_total = {model: 0 for model in models}
+        self.hedged_total = 0
+        self.hedge_wins_total = 0
+        self.failovers_total = 0
+
+    def available(self) -> List[ModelType]:
+        """Backends not known to be down, best first"""
+        healthy = [model for model in self.estimates if self.clients.get(model).breaker.state != "open"]
+        return sorted(healthy, key=lambda model: self.estimates[model].score())
+
+    def circuit_open(self, model: ModelType) -> bool:
+        """No backend of `model` would take a call now"""
+        if model == ModelType.auto:
+            return not self.available()
+        return self.clients.get(model).breaker.state == "open"
+
+    def hedge_delay(self, model: ModelType) -> Optional[float]:
+        """Seconds a call to `model` is given before it's hedged, None to never hedge it"""
+        if ML_AUTO_HEDGE_PERCENTILE <= 0:
+            return None
+        estimate = self.estimates[model]
+        delay = estimate.percentile(ML_AUTO_HEDGE_PERCENTILE) if len(estimate.latencies) >= MIN_SAMPLES else None
+        return max(delay if delay is not None else ML_AUTO_HEDGE_DEFAULT_SECONDS, ML_AUTO_HEDGE_MIN_SECONDS)
+
+    async def call(
+        self,
+        attempt: Callable[[ModelType], Awaitable[T]],
+        discard: Optional[Callable[[T], None]] = None
+    ) -> Tuple[ModelType, T]:
+        """
+        Runs `attempt(model)` on the best backend, hedged on the next one once
+        it's slow, or right away if it fails. Returns backend and result of the
+        first one to succeed, results of others are given to `discard`
+        """
+        ranked = self.available()
+        if not ranked:
+            raise CircuitOpenError("Circuit is open for all backends")
+        primary, fallback = ranked[0], ranked[1] if len(ranked) > 1 else None
+
+        calls: Dict[asyncio.Task, ModelType] = {}
+        started: Dict[ModelType, float] = {}
+        hedged = False
+
+        def launch(model: ModelType):
+            started[model] = monotonic()
+            calls[asyncio.create_task(attempt(model))] = model
+
+        launch(primary)
+        delay = self.hedge_delay(primary) if fallback is not None else None
+        error: Optional[BaseException] = None
+        try:
+            while calls:
+                waiting = delay if fallback not in started else None
+                done, _ = await asyncio.wait(calls, timeout=waiting, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Slower than usual, duplicate goes to the other backend
+                    hedged = True
+                    self.hedged_total += 1
+                    launch(fallback)
+                    continue
+
+                for call in done:
+                    model = calls.pop(call)
+                    if call.exception() is None:
+                        self.estimates[model].record(monotonic() - started[model])
+                        self._won(model, hedged and model == fallback, hedged)
+                        return model, call.result()
+                    self.estimates[model].record(None, failed=True)
+                    error = call.exception()
+
+                if fallback is not None and fallback not in started:
+                    self.failovers_total += 1
+                    launch(fallback)
+
+            if hedged:
+                ML_HEDGES_TOTAL.labels("none").inc()
+            raise error
+        finally:
+            await self._cancel(calls, started, discard)
+
+    def _won(self, model: ModelType, by_hedge: bool, hedged: bool):
+        self.routed_total[model] += 1
+        ML_AUTO_ROUTED_TOTAL.labels(model.value).inc()
+        if hedged:
+            self.hedge_wins_total += by_hedge
+            ML_HEDGES_TOTAL.labels("hedge" if by_hedge else "primary").inc()
+
+    async def _cancel(self, calls: Dict[asyncio.Task, ModelType], started: Dict[ModelType, float],
+                      discard: Optional[Callable]):
+        for call, model in calls.items():
+            if call.done():
+                # Finished along with the winner
+                if not call.cancelled() and call.exception() is None:
+                    self.estimates[model].record(monotonic() - started[model])
+                    if discard is not None:
+                        discard(call.result())
+                continue
+            call.cancel()
+            self.estimates[model].record_censored(monotonic() - started[model])
+        if calls:
+            await asyncio.wait(calls)
+
+    def stats(self) -> dict:
+        backends = {}
+        for model, estimate in self.estimates.items():
+            p50, p95 = estimate.percentile(0.5), estimate.percentile(0.95)
+            backends[model.value] = {
+                "circuit": self.clients.get(model).breaker.state,
+                "samples": len(estimate.failures),
+                "p50Seconds": round(p50, 3) if p50 is not None else None,
+                "p95Seconds": round(p95, 3) if p95 is not None else None,
+                "errorRate": round(estimate.error_rate, 3),
+                "hedgeDelaySeconds": self.hedge_delay(model),
+                "routed": self.routed_total[model],
+            }
+        return {
+            "backends": backends,
+            "ranking": [model.value for model in self.available()],
+            "hedged": self.hedged_total,
+            "hedgeWins": self.hedge_wins_total,
+            "failovers": self.failovers_total,
+        }
+
+
+ml_router = MLRouter(ml_clients, AUTO_MODELS, ML_AUTO_LATENCY_WINDOW)
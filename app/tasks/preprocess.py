@@ -0,0 +1,125 @@
+"""
+Preprocessing of images before they're sent to ML backends: downscaled to
+the longest side configured for the operation, if any, and stripped of
+metadata. Results are as large as what's sent, so none is set by default.
+Decoding and encoding run in a process pool, off the event loop
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from time import perf_counter
+from typing import Any, Callable, Optional, Tuple
+
+from PIL import Image as PILImage, ImageOps
+
+from ..config import PREPROCESS_ENABLED, PREPROCESS_JPEG_QUALITY, PREPROCESS_MAX_SIDE_BACKGROUND_REMOVE, \
+    PREPROCESS_MAX_SIDE_SUPER_RESOLUTION, PREPROCESS_WORKERS
+from ..schemas import OperationType
+
+MAX_SIDE = {
+    OperationType.background_remove: PREPROCESS_MAX_SIDE_BACKGROUND_REMOVE,
+    OperationType.super_resolution: PREPROCESS_MAX_SIDE_SUPER_RESOLUTION,
+}
+
+# Dropped on re-encode, colour profile is kept since it changes how pixels look
+METADATA_KEYS = ("exif", "xmp", "XML:com.adobe.xmp", "comment")
+
+# Formats whose metadata can change how pixels are shown (EXIF orientation),
+# which backends may ignore, so it's applied to pixels before sending
+ORIENTED_EXTENSIONS = ("jpeg", "jpg")
+
+
+def needs_preprocess(task: OperationType, extension: str) -> bool:
+    """Whether a parent goes through preprocessing before `task`, rather than sent as stored"""
+    return PREPROCESS_ENABLED and (MAX_SIDE[task] > 0 or extension.lower() in ORIENTED_EXTENSIONS)
+
+
+def preprocess_image(data: bytes, max_side: int, quality: int) -> Tuple[bytes, bool]:
+    """
+    Returns image to send and whether it was downscaled. Size and metadata are
+    read from the header, images needing neither change are never decoded
+    """
+    with PILImage.open(BytesIO(data)) as image:
+        image_format = image.format
+        downscale = max_side > 0 and max(image.size) > max_side
+        if not downscale and not any(key in image.info for key in METADATA_KEYS):
+            return data, False
+
+        if downscale:
+            # JPEG decodes right at a fraction of the size, at least max_side
+            image.draft(image.mode, (max_side, max_side))
+        # Orientation is applied to pixels, EXIF that carries it is dropped
+        pixels = ImageOps.exif_transpose(image)
+        if downscale:
+            pixels.thumbnail((max_side, max_side), PILImage.LANCZOS)
+
+        params = {"icc_profile": image.info.get("icc_profile")}
+        if image_format == "JPEG":
+            params["quality"] = quality
+
+        output = BytesIO()
+        pixels.save(output, format=image_format, **params)
+
+    processed = output.getvalue()
+    # Re-encoding just to strip metadata may not pay off
+    if not downscale and len(processed) >= len(data):
+        return data, False
+    return processed, downscale
+
+
+class Preprocessor:
+    """Process pool started on first use, with process-wide counters"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+        self.images_total = 0
+        self.downscaled_total = 0
+        self.errors_total = 0
+        self.bytes_in_total = 0
+        self.bytes_out_total = 0
+        self.seconds_total = 0.0
+
+    async def call(self, fn: Callable[..., Any], *args) -> Any:
+        """Runs `fn`, a module level function, in the pool"""
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers)
+        return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+
+    async def run(self, data: bytes, task: OperationType) -> bytes:
+        """Image to send for `task`, the original one if preprocessing fails"""
+        started = perf_counter()
+        try:
+            processed, downscaled = await self.call(preprocess_image, data, MAX_SIDE[task], PREPROCESS_JPEG_QUALITY)
+        except Exception as e:
+            print(f"Preprocessing failed, sending original: {e} ({type(e)})")
+            self.errors_total += 1
+            return data
+
+        self.images_total += 1
+        self.downscaled_total += downscaled
+        self.bytes_in_total += len(data)
+        self.bytes_out_total += len(processed)
+        self.seconds_total += perf_counter() - started
+        return processed
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+        self._pool = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": PREPROCESS_ENABLED,
+            "images": self.images_total,
+            "downscaled": self.downscaled_total,
+            "errors": self.errors_total,
+            "bytesIn": self.bytes_in_total,
+            "bytesOut": self.bytes_out_total,
+            "bytesSaved": self.bytes_in_total - self.bytes_out_total,
+            "secondsTotal": round(self.seconds_total, 3),
+        }
+
+
+preprocessor = Preprocessor(PREPROCESS_WORKERS)
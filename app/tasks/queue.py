@@ -0,0 +1,213 @@
+from datetime import datetime, timedelta
+from typing import List, Optional
+from uuid import UUID
+
+from fastapi import BackgroundTasks
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from ..config import TRANSFORM_EXECUTOR, WORKER_LEASE_SECONDS, WORKER_MAX_ATTEMPTS
+from ..crud import set_image_status
+from ..models import Image, TransformJob
+from ..schemas import ModelType, OperationType
+from .scheduler import fair_scheduler
+from .transform import create_transformed_images, run_transform
+from .transform_cache import lookup_transform
+
+
+async def use_cached_transform(db: AsyncSession, parent: Image, child: Image, task: OperationType, model: ModelType) -> bool:
+    """
+    If the same content went through the same transform before, points
+    the child at that result and marks it ready, with the model that made it
+    """
+    cached = await lookup_transform(db, parent.contentHash, task, model)
+    if cached is None:
+        return False
+
+    child.objectId = cached.storageId
+    child.sizeBytes = cached.sizeBytes
+    child.etag = cached.etag
+    child.contentHash = cached.contentHash
+    child.modelType = cached.modelType
+    child.status = "ready"
+    child.uploadedAt = datetime.now()
+    child.transformedAt = datetime.now()
+    return True
+
+
+def _transform_job(from_uuid: UUID, from_extension: str, child: Image) -> TransformJob:
+    return TransformJob(
+        imageId=child.imageId,
+        fromImageId=from_uuid,
+        extension=from_extension,
+        operationType=child.type,
+        modelType=child.modelType,
+        status="queued",
+        attempts=0,
+        createdAt=datetime.now()
+    )
+
+
+async def schedule_transform(
+    db: AsyncSession,
+    background_tasks: BackgroundTasks,
+    parent: Image,
+    from_extension: str,
+    child: Image,
+    task: OperationType,
+    model: ModelType,
+    image: Optional[bytes] = None
+):
+    """
+    Hands transform over to the configured executor. In background, it waits
+    for its user's turn in the fair-share scheduler and starts from parent
+    `image` bytes, if given, without waiting for their upload. With the queue,
+    the job row is only added to `db`, so it's committed along with the child
+    image. Cached results are used without calling ML at all
+    """
+    if await use_cached_transform(db, parent, child, task, model):
+        return
+
+    # Bytes are read from whichever image holds the parent's object
+    from_uuid = parent.storageId
+
+    if TRANSFORM_EXECUTOR == "queue":
+        db.add(_transform_job(from_uuid, from_extension, child))
+        return
+
+    background_tasks.add_task(fair_scheduler.run, child.userId, run_transform, from_uuid,
+                              from_extension, child.imageId, task, model, image)
+
+
+async def schedule_transforms(
+    db: AsyncSession,
+    background_tasks: BackgroundTasks,
+    parent: Image,
+    from_extension: str,
+    children: List[Image],
+    image: Optional[bytes] = None
+):
+    """
+    Same as `schedule_transform` for several children of one parent, operation
+    and model are taken from the children. In background mode the parent is
+    fetched and encoded once for all of them
+    """
+    pending = [
+        child for child in children
+        if not await use_cached_transform(db, parent, child, OperationType(child.type), ModelType(child.modelType))
+    ]
+    if not pending:
+        return
+
+    from_uuid = parent.storageId
+
+    if TRANSFORM_EXECUTOR == "queue":
+        db.add_all([_transform_job(from_uuid, from_extension, child) for child in pending])
+        return
+
+    if len(pending) == 1:
+        child = pending[0]
+        background_tasks.add_task(fair_scheduler.run, child.userId, run_transform, from_uuid, from_extension,
+                                  child.imageId, OperationType(child.type), ModelType(child.modelType), image)
+        return
+
+    # Batch takes a single turn of its user
+    background_tasks.add_task(fair_scheduler.run, pending[0].userId, create_transformed_images, from_uuid, from_extension, [
+        (child.imageId, OperationType(child.type), ModelType(child.modelType)) for child in pending
+    ], image)
+
+
+async def claim_jobs(db: AsyncSession, worker_id: str, model: ModelType, limit: int) -> List[TransformJob]:
+    """
+    Claims up to `limit` queued jobs for `model` whose parent is uploaded,
+    rows locked by other workers are skipped rather than waited for.
+    Users take turns: first queued job of every user, then second ones and so on
+    """
+    parent = aliased(Image)
+    child = aliased(Image)
+    # Ranked in a subquery, row locks can't be taken next to window functions
+    turns = (
+        select(
+            TransformJob.jobId.label("job_id"),
+            TransformJob.createdAt.label("created_at"),
+            func.row_number().over(partition_by=child.userId, order_by=TransformJob.createdAt).label("turn"))
+        .join(parent, parent.imageId == TransformJob.fromImageId)
+        .join(child, child.imageId == TransformJob.imageId)
+        .where(
+            TransformJob.status == "queued",
+            TransformJob.modelType == model,
+            parent.status == "ready")
+        .subquery()
+    )
+    # Filters are repeated on the locked rows: only these are rechecked against
+    # a row another worker claimed since the snapshot, which is then left out
+    jobs = (await db.scalars(
+        select(TransformJob)
+        .join(turns, turns.c.job_id == TransformJob.jobId)
+        .where(
+            TransformJob.status == "queued",
+            TransformJob.modelType == model)
+        .order_by(turns.c.turn, turns.c.created_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True, of=TransformJob)
+    )).all()
+
+    for job in jobs:
+        job.status = "running"
+        job.workerId = worker_id
+        job.attempts += 1
+        job.leaseExpiresAt = func.now() + timedelta(seconds=WORKER_LEASE_SECONDS)
+
+    await db.commit()
+    return jobs
+
+
+async def extend_leases(db: AsyncSession, worker_id: str, job_ids: List[UUID]):
+    if not job_ids:
+        return
+
+    await db.execute(
+        update(TransformJob)
+        .where(
+            TransformJob.jobId.in_(job_ids),
+            TransformJob.workerId == worker_id,
+            TransformJob.status == "running")
+        .values({"leaseExpiresAt": func.now() + timedelta(seconds=WORKER_LEASE_SECONDS)})
+    )
+    await db.commit()
+
+
+async def finish_job(db: AsyncSession, job_id: UUID, status: str):
+    await db.execute(
+        update(TransformJob)
+        .where(TransformJob.jobId == job_id)
+        .values({"status": status, "leaseExpiresAt": None})
+    )
+    await db.commit()
+
+
+async def requeue_expired(db: AsyncSession) -> int:
+    """
+    Returns jobs of dead workers back to the queue, or fails them and their
+    image once out of attempts
+    """
+    expired = (await db.scalars(
+        select(TransformJob)
+        .where(
+            TransformJob.status == "running",
+            TransformJob.leaseExpiresAt < func.now())
+        .with_for_update(skip_locked=True)
+    )).all()
+
+    for job in expired:
+        if job.attempts >= WORKER_MAX_ATTEMPTS:
+            job.status = "failed"
+            await set_image_status(db, job.imageId, "error")
+        else:
+            job.status = "queued"
+        job.workerId = None
+        job.leaseExpiresAt = None
+
+    await db.commit()
+    return len(expired)
@@ -0,0 +1,119 @@
+"""
+Fair-share scheduling of background transforms in the API process. One user
+queueing hundreds of transforms only gets a turn as often as anyone else
+with transforms waiting, queued jobs for workers are claimed the same way
+(tasks/queue.py, claim_jobs)
+"""
+import asyncio
+from collections import OrderedDict, deque
+from time import monotonic
+from typing import Any, Awaitable, Callable, Deque, Dict
+
+from ..config import TRANSFORM_CONCURRENCY, TRANSFORM_USER_CONCURRENCY
+
+
+class FairScheduler:
+    """
+    Runs at most `concurrency` transforms at a time, at most `per_user` of
+    one user (0 for no cap of its own). Free slots go round-robin to users
+    with transforms waiting, in order of their arrival within a user
+    """
+
+    def __init__(self, concurrency: int, per_user: int):
+        self.concurrency = concurrency
+        self.per_user = per_user
+        # userId -> waiting transforms, users in turn order
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._running: Dict[str, int] = {}
+
+        self.running = 0
+        self.started_total = 0
+        self.queued_total = 0
+        self.wait_seconds_total = 0.0
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def run(self, user_id: str, fn: Callable[..., Awaitable[Any]], *args) -> Any:
+        """Runs `fn(*args)` once it's `user_id`'s turn"""
+        await self._acquire(user_id)
+        try:
+            return await fn(*args)
+        finally:
+            self._release(user_id)
+
+    def _has_slot(self, user_id: str) -> bool:
+        return self.per_user <= 0 or self._running.get(user_id, 0) < self.per_user
+
+    def _start(self, user_id: str):
+        self.running += 1
+        self._running[user_id] = self._running.get(user_id, 0) + 1
+        self.started_total += 1
+
+    async def _acquire(self, user_id: str):
+        # Anyone waiting while a slot is free is held by its own cap
+        if self.running < self.concurrency and user_id not in self._queues and self._has_slot(user_id):
+            self._start(user_id)
+            return
+
+        self.queued_total += 1
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append(future)
+        started = monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Started just before being cancelled
+                self._release(user_id)
+            elif user_id in self._queues and future in self._queues[user_id]:
+                self._queues[user_id].remove(future)
+                if not self._queues[user_id]:
+                    del self._queues[user_id]
+            raise
+        finally:
+            self.wait_seconds_total += monotonic() - started
+
+    def _release(self, user_id: str):
+        self.running -= 1
+        self._running[user_id] -= 1
+        if not self._running[user_id]:
+            del self._running[user_id]
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.running < self.concurrency:
+            user_id = next((user_id for user_id in self._queues if self._has_slot(user_id)), None)
+            if user_id is None:
+                return
+
+            queue = self._queues[user_id]
+            future = queue.popleft()
+            # User goes to the back of the turn order
+            if queue:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+
+            if future.done():
+                # Cancelled, its task hasn't run yet to dequeue it
+                continue
+            self._start(user_id)
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "perUser": self.per_user,
+            "running": self.running,
+            "waiting": self.waiting,
+            "usersRunning": len(self._running),
+            "usersWaiting": len(self._queues),
+            "started": self.started_total,
+            "queued": self.queued_total,
+            "waitSecondsTotal": round(self.wait_seconds_total, 3),
+        }
+
+
+fair_scheduler = FairScheduler(TRANSFORM_CONCURRENCY, TRANSFORM_USER_CONCURRENCY)
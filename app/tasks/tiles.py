@@ -0,0 +1,99 @@
+"""
+Splitting of large images into overlapping tiles transformed one by one, and
+stitching of transformed tiles back into an image. Both are CPU bound and
+meant to run in the preprocessing process pool
+"""
+from io import BytesIO
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from PIL import Image as PILImage
+
+
+class TileGrid(NamedTuple):
+    # (width, height) of the whole image
+    size: Tuple[int, int]
+    format: str
+    mode: str
+    overlap: int
+    # (left, top) of each tile, in row order
+    positions: List[Tuple[int, int]]
+    # Each tile PNG encoded, lossless so artifacts don't add up
+    tiles: List[bytes]
+
+
+def _starts(length: int, tile: int, overlap: int) -> List[int]:
+    """Tile offsets along one side, last tile is aligned to the end"""
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, tile - overlap))
+    return starts + [length - tile]
+
+
+def split_tiles(data: bytes, tile: int, overlap: int) -> Optional[TileGrid]:
+    """Tiles of at most `tile` px a side overlapping by `overlap`, None if image fits in one"""
+    with PILImage.open(BytesIO(data)) as image:
+        width, height = image.size
+        if max(width, height) <= tile:
+            return None
+
+        image_format = image.format
+        mode = "RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB"
+        pixels = np.asarray(image.convert(mode))
+
+    positions = []
+    tiles = []
+    for top in _starts(height, tile, overlap):
+        for left in _starts(width, tile, overlap):
+            output = BytesIO()
+            PILImage.fromarray(pixels[top:top + tile, left:left + tile]).save(output, format="PNG")
+            positions.append((left, top))
+            tiles.append(output.getvalue())
+
+    return TileGrid((width, height), image_format, mode, overlap, positions, tiles)
+
+
+def _ramp(length: int, fade: int, fade_in: bool) -> np.ndarray:
+    """Weights along one side of a tile, rising over its first `fade` px if `fade_in`"""
+    ramp = np.ones(length, dtype=np.float32)
+    if fade_in and fade > 0:
+        steps = (np.arange(min(fade, length), dtype=np.float32) + 1) / (fade + 1)
+        ramp[:len(steps)] = steps
+    return ramp
+
+
+def stitch_tiles(grid: TileGrid, transformed: List[bytes], quality: int) -> bytes:
+    """
+    Image out of transformed tiles, encoded as the original. Scale is taken
+    from the first tile. Tiles are laid in row order, each fading in over the
+    overlap with tiles already laid above and left of it, so seams are blended
+    without holding a float copy of the whole image
+    """
+    width, height = grid.size
+    with PILImage.open(BytesIO(grid.tiles[0])) as source, PILImage.open(BytesIO(transformed[0])) as result:
+        scale = result.size[0] / source.size[0]
+    canvas = np.zeros((round(height * scale), round(width * scale), len(grid.mode)), dtype=np.uint8)
+    fade = round(grid.overlap * scale)
+
+    for (left, top), tile, data in zip(grid.positions, grid.tiles, transformed):
+        x, y = round(left * scale), round(top * scale)
+        with PILImage.open(BytesIO(tile)) as source, PILImage.open(BytesIO(data)) as result:
+            expected = (min(round(source.size[0] * scale), canvas.shape[1] - x),
+                        min(round(source.size[1] * scale), canvas.shape[0] - y))
+            result = result.convert(grid.mode)
+        if result.size != expected:
+            result = result.resize(expected, PILImage.LANCZOS)
+        pixels = np.asarray(result, dtype=np.float32)
+        h, w = pixels.shape[:2]
+
+        weight = np.outer(_ramp(h, fade, y > 0), _ramp(w, fade, x > 0))[..., None]
+        region = canvas[y:y + h, x:x + w]
+        region[...] = np.rint(pixels * weight + region * (1 - weight)).astype(np.uint8)
+
+    output = BytesIO()
+    params = {"quality": quality} if grid.format == "JPEG" else {}
+    stitched = PILImage.fromarray(canvas, grid.mode)
+    if grid.format == "JPEG" and grid.mode == "RGBA":
+        stitched = stitched.convert("RGB")
+    stitched.save(output, format=grid.format, **params)
+    return output.getvalue()
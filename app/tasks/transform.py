@@ -1,152 +1,418 @@
-from asyncio import sleep
+from asyncio import Semaphore, create_task, gather
+from contextlib import asynccontextmanager
 from datetime import datetime
-from ssl import SSLCertVerificationError
+from io import BytesIO
+from time import perf_counter
+from typing import AsyncIterator, BinaryIO, Callable, List, Optional, Tuple
 from uuid import UUID
-import base64
 
-from tenacity import before_sleep_log, retry, stop_after_attempt, wait_fixed, wait_random
-from .upload import upload_stream_to_s3, get_image_buffer_test
-from ..models import Image
+from tenacity import before_sleep_log, retry, retry_if_not_exception_type, stop_after_attempt, wait_fixed, wait_random
+from .buffers import buffer_manager
+from .decoder import AI24_IMAGE_PATH, PREDICTIONS_PATH, Base64JsonValueDecoder
+from .ml_client import CircuitOpenError, ml_clients
+from .ml_router import ml_router
+from .encoder import Base64JsonBody, EncodedJsonBody
+from .preprocess import needs_preprocess, preprocessor
+from .tiles import split_tiles, stitch_tiles
+from .transform_cache import store_transform
+from .upload import upload_stream_to_s3, get_image_buffer, get_image_buffer_generator_s3, get_image_size
+from .upload_registry import upload_registry
+from .. import crud
 from ..schemas import ModelType, OperationType
 from ..database import SessionLocal
-from sqlalchemy import update
-from ..config import ML_SSL_VERIFY, ML_INTERNAL_URL, ML_WORKSPACE_ID, ML_24AI_TOKEN, ML_24AI_URL, ML_RETRY_INTERVAL, ML_RETRY_ATTEMPTS
+from ..metrics import BYTES_TOTAL, ML_RETRIES_TOTAL, count_transform, stage_timer, track_transform
+from ..config import ML_RETRY_INTERVAL, ML_RETRY_ATTEMPTS, ML_FANOUT_CONCURRENCY, \
+    PREPROCESS_JPEG_QUALITY, SR_TILING_ENABLED, SR_TILE_SIZE, SR_TILE_OVERLAP, SR_TILE_CONCURRENCY, \
+    TRANSFORM_SPOOL_MAX_BYTES
 from tempfile import SpooledTemporaryFile
-import httpx
 import logging
 
 logger = logging.getLogger(__name__)
 
 async def set_image_status(image_id: UUID | str, status):
-  with SessionLocal() as db:
-      db.execute(
-          update(Image)
-        .where(Image.imageId == image_id)
-        .values({"status": status})
-      )
-      db.commit()
-      db.close()
+  async with SessionLocal() as db:
+      await crud.set_image_status(db, image_id, status)
+      await db.commit()
       print("Transformed image marked with status: ", status)
 
-@retry(
+
+async def fail_transform(to_uuid: UUID | str, task: OperationType, model: ModelType, outcome: str):
+    count_transform(task, model, outcome)
+    await set_image_status(to_uuid, "error")
+
+
+_log_retry = before_sleep_log(logger, logging.ERROR)
+
+
+def before_retry(retry_state):
+    ML_RETRIES_TOTAL.labels(ModelType(retry_state.args[0]).value).inc()
+    _log_retry(retry_state)
+
+
+ml_retry = retry(
         wait=wait_fixed(ML_RETRY_INTERVAL) + wait_random(0, 2),
         stop=stop_after_attempt(ML_RETRY_ATTEMPTS),
-        before_sleep=before_sleep_log(logger, logging.ERROR)
+        retry=retry_if_not_exception_type(CircuitOpenError),
+        before_sleep=before_retry,
+        reraise=True
         )
-async def ml_call(model: ModelType, image_base64: str, task: OperationType, temp_file: SpooledTemporaryFile[bytes]):
+
+
+@ml_retry
+async def ml_call(model: ModelType, body: Base64JsonBody, temp_file: SpooledTemporaryFile[bytes]):
+    # Drop whatever a failed attempt managed to write
     temp_file.seek(0)
+    temp_file.truncate()
+    await ml_attempt(model, body, temp_file)
+
+
+@ml_retry
+async def ml_call_auto(
+    model: ModelType,
+    body_for: Callable[[ModelType], Base64JsonBody]
+) -> Tuple[ModelType, SpooledTemporaryFile[bytes]]:
+    """
+    Call of an `auto` `model` transform, routed and hedged between backends
+    by ml_router, every attempt on its own temp file. Returns the backend
+    which made the result and the file holding it
+    """
+    async def attempt(backend: ModelType) -> SpooledTemporaryFile[bytes]:
+        temp_file = SpooledTemporaryFile(max_size=TRANSFORM_SPOOL_MAX_BYTES)
+        try:
+            await ml_attempt(backend, body_for(backend), temp_file)
+        except BaseException:
+            temp_file.close()
+            raise
+        return temp_file
 
-    ml_url = ML_INTERNAL_URL if model == ModelType.internal else ML_24AI_URL
+    return await ml_router.call(attempt, lambda temp_file: temp_file.close())
 
-    if model == ModelType.ai24:
-        ml_url += 'remove-background'
 
-    req_body = {
-        "image": image_base64,
-        "task": task
-    } if model == ModelType.internal else {
-        "image": image_base64
-    }
+async def ml_attempt(model: ModelType, body: Base64JsonBody, temp_file: SpooledTemporaryFile[bytes]):
+    """Single call to `model` backend, its result decoded into `temp_file`"""
+    backend = ml_clients.get(model)
 
-    headers = {
-        "content-type": "application/json",
-        "x-workspace-id": ML_WORKSPACE_ID
-    } if model == ModelType.internal else {
-        "content-type": "application/json",
-        "authorization": f"Token {ML_24AI_TOKEN}"
-    }
+    # Decoded straight into the file as response chunks arrive
+    decoder = Base64JsonValueDecoder(
+        PREDICTIONS_PATH if model == ModelType.internal else AI24_IMAGE_PATH, temp_file.write)
 
-    # For decoding chunks not suitable for decoding yet
-    buffer = b""
+    # Body is streamed from its source on every attempt
+    BYTES_TOTAL.labels("ml_sent").inc(len(body))
+    async with backend.stream(content=body, headers=body.headers) as response:
+        async for chunk in response.aiter_bytes():
+            decoder.feed(chunk)
+        # Truncated response counts as backend failure
+        decoder.close()
+    BYTES_TOTAL.labels("ml_received").inc(temp_file.tell())
 
-    image_chunk_start_key = b"predictions\":\""
-    image_chunk_start_index = 16
 
-    image_chunk_end_key = b"\"}"
-    image_chunk_end_index = -3
+def request_fields(task: OperationType, model: ModelType) -> dict:
+    return {"task": task} if model == ModelType.internal else {}
 
-    # For model-dependant chunking
-    if model == ModelType.ai24:
-        #  {"success":true,"code":200,"message":"","error":"","data":{"image":"
-        image_chunk_start_key = b"data\":{\"image\":\""
-        image_chunk_start_index = 68
 
-        image_chunk_end_key = b"\"}}"
-        image_chunk_end_index = -4  
+# Operations done tile by tile on large images
+TILED_OPERATIONS = (OperationType.super_resolution,) if SR_TILING_ENABLED else ()
 
-    async with httpx.AsyncClient(verify=ML_SSL_VERIFY) as client:
-        async with client.stream("POST", url=ml_url, json=req_body, headers=headers, timeout=60) as response:
-            if response.is_error:
-                await response.aread()
-                raise BaseException(response.content)
+# Memory held per byte of parent: the parent itself, then per operation its
+# preprocessed copy and base64 body, and per transform its result, which has
+# 4x the pixels after super-resolution
+PARENT_FOOTPRINT = 1
+OPERATION_FOOTPRINT = 2.5
+RESULT_FOOTPRINT = {
+    OperationType.background_remove: 2,
+    OperationType.super_resolution: 8,
+}
 
-            async for chunk in response.aiter_bytes():
-                chunk = chunk.replace(b"\\", b"")
-                chunk = buffer + chunk
 
-                # Extract  b'{"predictions":"saddsfdfd...
-                if image_chunk_start_key in chunk:
-                    chunk = chunk[image_chunk_start_index:]
-                if image_chunk_end_key in chunk:
-                    chunk = chunk[:image_chunk_end_index]
+def transform_footprint(size: int, tasks: List[OperationType]) -> int:
+    """
+    Estimated peak memory of transforms of a `size` bytes parent into `tasks`.
+    Results spill to disk past TRANSFORM_SPOOL_MAX_BYTES, tiled ones are
+    stitched in memory
+    """
+    footprint = size * (PARENT_FOOTPRINT + OPERATION_FOOTPRINT * len(set(tasks)))
+    for task in tasks:
+        result = size * RESULT_FOOTPRINT[task]
+        footprint += result if task in TILED_OPERATIONS else min(result, TRANSFORM_SPOOL_MAX_BYTES)
+    return int(footprint)
 
-                # Calculate how much can be cleanly decoded
-                cut_off = len(chunk) % 4
-                buffer = chunk[-cut_off:] if cut_off != 0 else b""
-                chunk_to_decode = chunk[:-cut_off] if cut_off != 0 else chunk
 
-                # If enough bytes for decode is collected - do it, otherwise wait for next buffer + chunk
-                if chunk_to_decode:
-                    temp_file.write(base64.b64decode(
-                        chunk_to_decode + b'==', validate=False))
+@asynccontextmanager
+async def admitted(
+    size: int,
+    tasks: List[OperationType],
+    task: Optional[OperationType] = None,
+    model: Optional[ModelType] = None
+) -> AsyncIterator[None]:
+    """Holds memory budget of transforms of a `size` bytes parent while inside, waiting for it first"""
+    with stage_timer("admission", task, model):
+        reserved = await buffer_manager.acquire(transform_footprint(size, tasks))
+    try:
+        yield
+    finally:
+        buffer_manager.release(reserved)
+
+
+async def parent_size(from_uuid: str, from_extension: str, image: Optional[bytes], task: Optional[OperationType] = None,
+                      model: Optional[ModelType] = None) -> int:
+    """Size of parent bytes in hand, or of its object, once this process is done uploading it"""
+    if image is not None:
+        return len(image)
+    with stage_timer("wait", task, model):
+        await upload_registry.wait(from_uuid)
+    return await get_image_size(from_uuid, from_extension)
 
 
-async def create_transformed_image(from_uuid: str, from_extension: str, to_uuid: str, task: OperationType, model: ModelType):
-    # TODO: Chain with upload end, can't isolate completely from original
-    # for now
-    await sleep(1)
-    print(f"Transforming from {from_uuid}.{from_extension}: {model}/{task}")
+async def create_transformed_image(
+    from_uuid: str,
+    from_extension: str,
+    to_uuid: str,
+    task: OperationType,
+    model: ModelType,
+    image: Optional[bytes] = None
+):
+    """
+    Transforms parent into `to_uuid`. Parent `image` bytes, if in hand, are
+    used as is, while they may still be on their way to S3
+    """
+    with track_transform(task, model):
+        print(f"Transforming from {from_uuid}.{from_extension}: {model}/{task}")
 
-    # Step 1: Download parent from S3
-    buffer_generator = get_image_buffer_test(from_uuid, from_extension)
+        # Don't even fetch the parent while backend is known to be down
+        if ml_router.circuit_open(model):
+          print(f"ML Call rejected, circuit open: {model}/{task}/{from_uuid}")
+          await fail_transform(to_uuid, task, model, "circuit_open")
+          return
 
-    # Step 2: Encode to base64
-    base64_encoded = base64.b64encode(buffer_generator.read()).decode('utf-8')
+        # Step 1: Wait for memory to hold the transform, then fetch and
+        # preprocess parent, or stream it from S3 as is, base64 encoded on the
+        # fly while sent to external service
+        # Streamed, fetching and encoding count into ml_call
+        size = await parent_size(from_uuid, from_extension, image, task, model)
+        async with admitted(size, [task], task, model):
+            preprocess = needs_preprocess(task, from_extension)
+            if image is not None or preprocess or task in TILED_OPERATIONS:
+                if image is None:
+                    with stage_timer("fetch", task, model):
+                        image = await get_image_buffer(from_uuid, from_extension)
+                if preprocess:
+                    with stage_timer("preprocess", task, model):
+                        image = await preprocessor.run(image, task)
+                if task in TILED_OPERATIONS and await transform_tiled(image, from_uuid, from_extension, to_uuid, task, model):
+                    return
+                with stage_timer("encode", task, model):
+                    encoded = EncodedJsonBody.encode(image)
+                body_for = lambda backend: EncodedJsonBody(encoded, request_fields(task, backend))
+            else:
+                body_for = lambda backend: Base64JsonBody(
+                    lambda: get_image_buffer_generator_s3(from_uuid, from_extension),
+                    size,
+                    request_fields(task, backend))
 
-    # Step 3: POST to external service
-    # TODO: Add retry/backoff https://stackoverflow.com/questions/15431044/can-i-set-max-retries-for-requests-request
+            await transform_with_body(body_for, from_uuid, from_extension, to_uuid, task, model)
 
-    # Step 4: Upload back to S3
-    temp_file = SpooledTemporaryFile(max_size=1024)
-    err = ""
 
+async def run_transform(
+    from_uuid: str,
+    from_extension: str,
+    to_uuid: str,
+    task: OperationType,
+    model: ModelType,
+    image: Optional[bytes] = None
+):
+    """
+    `create_transformed_image` run in this process, where nothing retries it
+    or expires it: a failure it doesn't handle itself, e.g. fetching the
+    parent, marks the image as error
+    """
     try:
-      await ml_call(model, base64_encoded, task, temp_file)
-    except (Exception, SSLCertVerificationError) as err:
-      print(f"ML Call error: {model}/{task}/{from_uuid} err: {err.reason} {err.args[0]}") 
-      temp_file.close()
-      await set_image_status(to_uuid, "error")
-      return
-    except (BaseException) as err:
-      print(f"ML Call error: {model}/{task}/{from_uuid} err: {err.args[0]}") 
-      temp_file.close()
-      await set_image_status(to_uuid, "error")
+        await create_transformed_image(from_uuid, from_extension, to_uuid, task, model, image)
+    except Exception as e:
+        print(f"Transform error: {model}/{task}/{to_uuid} err: {e!r}")
+        await fail_transform(to_uuid, task, model, "error")
+
+
+async def create_transformed_images(
+    from_uuid: str,
+    from_extension: str,
+    targets: List[Tuple[UUID, OperationType, ModelType]],
+    image: Optional[bytes] = None
+):
+    """
+    Fan-out of several transforms of one parent: it's fetched and encoded
+    once, or taken from `image` bytes in hand, then ML calls run
+    concurrently, at most ML_FANOUT_CONCURRENCY at a time. Runs in this
+    process only, so if the parent can't be had every target is failed
+    """
+    started = perf_counter()
+    print(f"Transforming from {from_uuid}.{from_extension} into {len(targets)} images")
+
+    # Step 1: Wait for memory to hold the whole batch, then fetch parent once,
+    # preprocessed once per operation, base64 is shared by all request bodies
+    # of an operation. Failures of single targets are handled in transform_batch
+    try:
+        size = await parent_size(from_uuid, from_extension, image)
+        async with admitted(size, [task for _, task, _ in targets]):
+            await transform_batch(from_uuid, from_extension, targets, started, image)
+    except Exception as e:
+        print(f"Transform error: {from_uuid} into {len(targets)} images err: {e!r}")
+        for to_uuid, task, model in targets:
+            await fail_transform(to_uuid, task, model, "error")
+
+
+async def transform_batch(
+    from_uuid: str,
+    from_extension: str,
+    targets: List[Tuple[UUID, OperationType, ModelType]],
+    started: float,
+    image: Optional[bytes] = None
+):
+    if image is None:
+        with stage_timer("fetch"):
+            image = await get_image_buffer(from_uuid, from_extension)
+    tasks = list({task for _, task, _ in targets})
+
+    async def prepared(task: OperationType) -> bytes:
+        if not needs_preprocess(task, from_extension):
+            return image
+        return await preprocessor.run(image, task)
+
+    with stage_timer("preprocess"):
+        images = await gather(*(prepared(task) for task in tasks))
+    preprocessed = dict(zip(tasks, images))
+    with stage_timer("encode"):
+        encoded = {task: EncodedJsonBody.encode(image) for task, image in preprocessed.items()}
+    limit = Semaphore(ML_FANOUT_CONCURRENCY)
+
+    async def transform(to_uuid: UUID, task: OperationType, model: ModelType):
+        async with limit:
+            if ml_router.circuit_open(model):
+                print(f"ML Call rejected, circuit open: {model}/{task}/{from_uuid}")
+                await fail_transform(to_uuid, task, model, "circuit_open")
+                return
+
+            if task in TILED_OPERATIONS and await transform_tiled(
+                    preprocessed[task], from_uuid, from_extension, to_uuid, task, model):
+                return
+
+            body_for = lambda backend: EncodedJsonBody(encoded[task], request_fields(task, backend))
+            await transform_with_body(body_for, from_uuid, from_extension, to_uuid, task, model)
+
+    async def tracked(to_uuid: UUID, task: OperationType, model: ModelType):
+        with track_transform(task, model, started):
+            await transform(to_uuid, task, model)
+
+    results = await gather(*(tracked(*target) for target in targets), return_exceptions=True)
+    for (to_uuid, task, model), result in zip(targets, results):
+        if isinstance(result, Exception):
+            print(f"Transform error: {model}/{task}/{to_uuid} err: {result!r}")
+            await fail_transform(to_uuid, task, model, "error")
+
+
+async def transform_with_body(
+    body_for: Callable[[ModelType], Base64JsonBody],
+    from_uuid: str,
+    from_extension: str,
+    to_uuid: str,
+    task: OperationType,
+    model: ModelType
+):
+    """Transform with request body of the backend it goes to, `body_for(backend)`"""
+    # Step 2: POST to external service, decoding result into temp file
+    temp_file = None
+
+    try:
+      with stage_timer("ml_call", task, model):
+          if model == ModelType.auto:
+              used, temp_file = await ml_call_auto(model, body_for)
+          else:
+              used, temp_file = model, SpooledTemporaryFile(max_size=TRANSFORM_SPOOL_MAX_BYTES)
+              await ml_call(model, body_for(model), temp_file)
+    except Exception as err:
+      print(f"ML Call error: {model}/{task}/{from_uuid} err: {err!r}")
+      if temp_file is not None:
+          temp_file.close()
+      await fail_transform(to_uuid, task, model, "ml_error")
       return
 
     temp_file.seek(0)
+    await store_transformed(temp_file, from_uuid, from_extension, to_uuid, task, model, used)
+    temp_file.close()
 
-    # Step 5: Pass file descriptor to s3
-    await upload_stream_to_s3(temp_file, to_uuid, from_extension)
 
-    temp_file.close()
+async def transform_tiled(
+    image: bytes,
+    from_uuid: str,
+    from_extension: str,
+    to_uuid: str,
+    task: OperationType,
+    model: ModelType
+) -> bool:
+    """
+    Transforms image in overlapping tiles of SR_TILE_SIZE, at most
+    SR_TILE_CONCURRENCY at a time, each retried on its own, and stitches the
+    results. Returns False, doing nothing, if the image fits in a single tile
+    """
+    try:
+        with stage_timer("tile_split", task, model):
+            grid = await preprocessor.call(split_tiles, image, SR_TILE_SIZE, SR_TILE_OVERLAP)
+    except Exception as e:
+        print(f"Tiling failed, sending whole image: {e} ({type(e)})")
+        return False
+    if grid is None:
+        return False
 
-    # Step 6: Set transform status
-    with SessionLocal() as db:
-        db.execute(
-            update(Image)
-          .where(Image.imageId == to_uuid)
-          .values({"status": "ready", "uploadedAt": datetime.now(), "transformedAt": datetime.now()})
-        )
-        db.commit()
-        db.close()
+    print(f"Transforming {from_uuid} in {len(grid.tiles)} tiles: {model}/{task}")
+    limit = Semaphore(SR_TILE_CONCURRENCY)
+
+    async def transform_tile(tile: bytes) -> bytes:
+        async with limit:
+            with SpooledTemporaryFile(max_size=TRANSFORM_SPOOL_MAX_BYTES) as temp_file, stage_timer("ml_call", task, model):
+                await ml_call(model, EncodedJsonBody(EncodedJsonBody.encode(tile), request_fields(task, model)), temp_file)
+                temp_file.seek(0)
+                return temp_file.read()
+
+    # Step 2: POST tiles to external service, first failure cancels the rest
+    calls = [create_task(transform_tile(tile)) for tile in grid.tiles]
+    try:
+        transformed = await gather(*calls)
+        with stage_timer("stitch", task, model):
+            stitched = await preprocessor.call(stitch_tiles, grid, transformed, PREPROCESS_JPEG_QUALITY)
+    except Exception as err:
+        for call in calls:
+            call.cancel()
+        print(f"ML Call error: {model}/{task}/{from_uuid} err: {err!r}")
+        await fail_transform(to_uuid, task, model, "ml_error")
+        return True
+
+    await store_transformed(BytesIO(stitched), from_uuid, from_extension, to_uuid, task, model)
+    return True
+
+
+async def store_transformed(
+    file: BinaryIO,
+    from_uuid: str,
+    from_extension: str,
+    to_uuid: str,
+    task: OperationType,
+    model: ModelType,
+    used: Optional[ModelType] = None
+):
+    """Stores result of a `model` transform, made by `used` backend if `model` is auto"""
+    used = used or model
+    # Step 3: Pass file descriptor to s3
+    with stage_timer("upload", task, model):
+        size, etag, content_hash = await upload_stream_to_s3(file, to_uuid, from_extension)
+
+    # Step 4: Set transform status
+    async with SessionLocal() as db:
+        with stage_timer("db_update", task, model):
+            await crud.update_image(db, to_uuid, status="ready", uploadedAt=datetime.now(),
+                                    transformedAt=datetime.now(), sizeBytes=size, etag=etag,
+                                    contentHash=content_hash, modelType=used)
+            await db.commit()
+        count_transform(task, model, "ready")
         print("Transformed image marked as ready")
+
+        # Step 5: Keep result for the same content and transform requested later
+        await store_transform(db, from_uuid, to_uuid, task, used)
@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta
+from typing import Optional
+from uuid import UUID
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.engine import Row
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..config import TRANSFORM_CACHE_ENABLED, TRANSFORM_CACHE_TTL_SECONDS
+from ..crud import get_content_hash
+from ..models import Image, TransformCache
+from ..schemas import ModelType, OperationType
+from .ml_router import AUTO_MODELS
+
+
+class TransformCacheStats:
+    """Process-wide counters, cumulative hits per entry are kept in the table"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": TRANSFORM_CACHE_ENABLED,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "stored": self.stored,
+            "evicted": self.evicted,
+        }
+
+
+cache_stats = TransformCacheStats()
+
+
+def _expires_before() -> datetime:
+    return datetime.now() - timedelta(seconds=TRANSFORM_CACHE_TTL_SECONDS)
+
+
+async def lookup_transform(
+    db: AsyncSession,
+    content_hash: Optional[str],
+    task: OperationType,
+    model: ModelType
+) -> Optional[Row]:
+    """
+    Returns stored result (imageId, storageId, sizeBytes, etag, contentHash,
+    modelType) of `task`/`model` over the content, if it's still there and
+    ready, and counts the hit. Results of any backend do for `auto`
+    """
+    if not TRANSFORM_CACHE_ENABLED or content_hash is None:
+        return None
+
+    models = AUTO_MODELS if model == ModelType.auto else (model,)
+    result = (await db.execute(
+        select(Image.imageId, Image.storageId.label("storageId"), Image.sizeBytes, Image.etag, Image.contentHash,
+               TransformCache.modelType)
+        .join(TransformCache, TransformCache.imageId == Image.imageId)
+        .where(
+            TransformCache.contentHash == content_hash,
+            TransformCache.operationType == task,
+            TransformCache.modelType.in_(models),
+            TransformCache.lastHitAt >= _expires_before(),
+            Image.status == "ready")
+        .limit(1)
+    )).first()
+
+    if result is None:
+        cache_stats.misses += 1
+        return None
+
+    cache_stats.hits += 1
+    await db.execute(
+        update(TransformCache)
+        .where(
+            TransformCache.contentHash == content_hash,
+            TransformCache.operationType == task,
+            TransformCache.modelType == result.modelType)
+        .values({"hits": TransformCache.hits + 1, "lastHitAt": datetime.now()})
+    )
+    return result
+
+
+async def store_transform(db: AsyncSession, source_uuid: UUID, to_uuid: UUID, task: OperationType, model: ModelType):
+    """Records `to_uuid` as result of `task`/`model` over content of `source_uuid`"""
+    if not TRANSFORM_CACHE_ENABLED:
+        return
+
+    content_hash = await get_content_hash(db, source_uuid)
+    if content_hash is None:
+        return
+
+    # Newer result replaces an expired or failed one
+    await db.merge(TransformCache(
+        contentHash=content_hash,
+        operationType=task,
+        modelType=model,
+        imageId=to_uuid,
+        hits=0,
+        createdAt=datetime.now(),
+        lastHitAt=datetime.now()
+    ))
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Same content transformed concurrently, first one stays
+        await db.rollback()
+        return
+    cache_stats.stored += 1
+
+
+async def evict_transform_cache(db: AsyncSession) -> int:
+    """
+    Drops entries not hit within TTL, result images and their objects stay,
+    they're owned by whoever requested them
+    """
+    result = await db.execute(
+        delete(TransformCache)
+        .where(TransformCache.lastHitAt < _expires_before())
+    )
+    await db.commit()
+    cache_stats.evicted += result.rowcount
+    return result.rowcount
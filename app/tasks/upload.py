@@ -1,114 +1,348 @@
-import aioboto3
-from sqlalchemy.orm import Session
-from sqlalchemy import update
-from tenacity import retry, wait_random_exponential
-from ..models import Image
+from hashlib import sha256
+from typing import AsyncIterator, BinaryIO, Iterator, Optional, Tuple
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+from .. import crud
+from ..database import SessionLocal
+from ..metrics import BYTES_TOTAL, UPLOADS_IN_FLIGHT
+from ..object_cache import CacheFill, object_cache
+from ..s3 import object_key, s3_pool
 from datetime import datetime
-from fastapi.responses import StreamingResponse
-import boto3
-from ..config import AWS_ACCESS_KEY_ID, AWS_REGION, AWS_SECRET_ACCESS_KEY, S3_BUCKET, S3_ENDPOINT_URL, IMAGE_DIR
-from smart_open import open
-import io
-
-session = aioboto3.Session(
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    region_name=AWS_REGION,
+from fastapi.responses import Response, StreamingResponse
+from botocore.exceptions import ClientError
+from ..config import S3_BUCKET, S3_READ_RETRY_ATTEMPTS, UPLOAD_PART_SIZE_BYTES, DOWNLOAD_CHUNK_SIZE_BYTES
+
+
+def is_missing(e: BaseException) -> bool:
+    """S3 error of an object that isn't there"""
+    return isinstance(e, ClientError) and e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+
+# Missing object stays missing, e.g. parent deleted while its child is queued
+s3_read_retry = retry(
+    wait=wait_random_exponential(multiplier=1, min=5, max=20),
+    stop=stop_after_attempt(S3_READ_RETRY_ATTEMPTS),
+    retry=retry_if_exception(lambda e: not is_missing(e)),
+    reraise=True
 )
 
-async def upload_stream_to_s3(stream_generator, filename: str, extension: str):
-    blob_s3_key = f"/{IMAGE_DIR}/{filename}.{extension}"
-    s3_client = boto3.client('s3',
-                            endpoint_url=S3_ENDPOINT_URL,
-                            aws_access_key_id=AWS_ACCESS_KEY_ID,
-                            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-                            region_name=AWS_REGION)
-    
-    with open(f's3://{S3_BUCKET}/{blob_s3_key}', 'wb', transport_params={'client': s3_client}) as fout:
-        for chunk in stream_generator:
-            fout.write(chunk)
-        print(f"Finished Uploading {blob_s3_key} to s3")
+async def upload_stream_to_s3(file: BinaryIO, filename: str, extension: str) -> Tuple[int, str, str]:
+    async def read_chunks():
+        while chunk := file.read(UPLOAD_PART_SIZE_BYTES):
+            yield chunk
+
+    return await upload_original_stream(read_chunks(), filename, extension)
 
 async def upload_original(
     file: bytes,
     filename: str,
-    extension: str,
-    db: Session
+    extension: str
 ) -> str:
-    blob_s3_key = f"/{IMAGE_DIR}/{filename}.{extension}"
+    blob_s3_key = object_key(filename, extension)
 
-    file_like_object = io.BytesIO(file)
-
-    async with session.client("s3", endpoint_url=S3_ENDPOINT_URL) as s3:
+    async with s3_pool.acquire() as s3:
         try:
             print(f"Uploading {blob_s3_key} to s3")
-            await s3.upload_fileobj(file_like_object, S3_BUCKET, blob_s3_key)
+            # Single put is fine up to 5GB, way above upload limit
+            with UPLOADS_IN_FLIGHT.track_inprogress():
+                response = await s3.put_object(Bucket=S3_BUCKET, Key=blob_s3_key, Body=file)
+            BYTES_TOTAL.labels("s3_write").inc(len(file))
             print(f"Finished Uploading {blob_s3_key} to s3")
         except Exception as e:
             print(f"Unable to s3 upload to {blob_s3_key}: {e} ({type(e)})")
             return ""
-        
-    db.execute(
-      update(Image)
-        .where(Image.imageId == filename)
-        .values({"status": "ready", "uploadedAt": datetime.now()})
-    )
-    db.commit()
-
-def get_image_buffer_generator_s3(uuid: str, extension: str):
-    # Initialize the S3 client
-    object_key = f"/{IMAGE_DIR}/{uuid}.{extension}"
-
-    s3_client = boto3.client('s3',
-                            endpoint_url=S3_ENDPOINT_URL,
-                            aws_access_key_id=AWS_ACCESS_KEY_ID,
-                            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-                            region_name=AWS_REGION)
-
-    # Get the object from S3
-    response = s3_client.get_object(Bucket=S3_BUCKET, Key=object_key)
-    
-    for chunk in response['Body'].iter_chunks(chunk_size=1024):
-      yield chunk
-
-@retry(
-wait=wait_random_exponential(multiplier=1, min=5, max=20)
-)
-def get_image_buffer_test(uuid: str, extension: str):
-    # Initialize the S3 client
-    object_key = f"/{IMAGE_DIR}/{uuid}.{extension}"
-
-    s3_client = boto3.client('s3',
-                            endpoint_url=S3_ENDPOINT_URL,
-                            aws_access_key_id=AWS_ACCESS_KEY_ID,
-                            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-                            region_name=AWS_REGION)
-
-    # Get the object from S3
-    response = s3_client.get_object(Bucket=S3_BUCKET, Key=object_key)
-    
-    return response['Body']
-
-s3_client = boto3.client('s3',
-                        endpoint_url=S3_ENDPOINT_URL,
-                        aws_access_key_id=AWS_ACCESS_KEY_ID,
-                        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-                        region_name=AWS_REGION)
-
-def get_image_content(uuid: str, extension: str, media_type: str):
-    # Initialize the S3 client
-    object_key = f"/{IMAGE_DIR}/{uuid}.{extension}"
-
-    # Get the object from S3
-    response = s3_client.get_object(Bucket=S3_BUCKET, Key=object_key)
-    
-    # Define a generator function to stream the data
-    def iterfile():
-        for chunk in response['Body'].iter_chunks(chunk_size=1024):
+
+    await object_cache.put(str(filename), response["ETag"], file)
+
+    async with SessionLocal() as db:
+        await crud.update_image(db, filename, status="ready", uploadedAt=datetime.now(), etag=response["ETag"])
+        await db.commit()
+
+async def upload_original_stream(
+    chunks: AsyncIterator[bytes],
+    filename: str,
+    extension: str
+) -> Tuple[int, str, str]:
+    """
+    Pipes `chunks` into S3 without holding the whole file, returns uploaded
+    size, ETag and sha256 hex of the content.
+    Small files go with a single put, larger ones via multipart upload, which
+    is aborted if the stream raises (e.g. on validation) midway.
+    Chunks are written to the object cache as well, kept once uploaded
+    """
+    blob_s3_key = object_key(filename, extension)
+    part = bytearray()
+    parts = []
+    upload_id = None
+    size = 0
+    content_hash = sha256()
+    fill = object_cache.begin_fill(str(filename))
+
+    async with s3_pool.acquire() as s3:
+        UPLOADS_IN_FLIGHT.inc()
+        try:
+            print(f"Streaming {blob_s3_key} to s3")
+            async for chunk in chunks:
+                part += chunk
+                size += len(chunk)
+                content_hash.update(chunk)
+                if fill is not None:
+                    await fill.write(chunk)
+
+                if len(part) < UPLOAD_PART_SIZE_BYTES:
+                    continue
+
+                if upload_id is None:
+                    multipart = await s3.create_multipart_upload(Bucket=S3_BUCKET, Key=blob_s3_key)
+                    upload_id = multipart["UploadId"]
+
+                parts.append(await _upload_part(s3, blob_s3_key, upload_id, len(parts) + 1, part))
+                part = bytearray()
+
+            if upload_id is None:
+                response = await s3.put_object(Bucket=S3_BUCKET, Key=blob_s3_key, Body=bytes(part))
+            else:
+                if part:
+                    parts.append(await _upload_part(s3, blob_s3_key, upload_id, len(parts) + 1, part))
+                response = await s3.complete_multipart_upload(
+                    Bucket=S3_BUCKET, Key=blob_s3_key, UploadId=upload_id,
+                    MultipartUpload={"Parts": parts})
+            BYTES_TOTAL.labels("s3_write").inc(size)
+            print(f"Finished Uploading {blob_s3_key} to s3")
+        except BaseException:
+            if fill is not None:
+                fill.abort()
+            if upload_id is not None:
+                await s3.abort_multipart_upload(Bucket=S3_BUCKET, Key=blob_s3_key, UploadId=upload_id)
+            raise
+        finally:
+            UPLOADS_IN_FLIGHT.dec()
+
+    if fill is not None:
+        await fill.commit(response["ETag"])
+    return size, response["ETag"], content_hash.hexdigest()
+
+async def _upload_part(s3, key: str, upload_id: str, number: int, body: bytearray) -> dict:
+    response = await s3.upload_part(
+        Bucket=S3_BUCKET, Key=key, UploadId=upload_id, PartNumber=number, Body=bytes(body))
+    return {"PartNumber": number, "ETag": response["ETag"]}
+
+def iter_mapped(mapped, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+    """Chunks of a cached object's map from `start` up to `end` inclusive, unmapped once over"""
+    end = len(mapped) - 1 if end is None else end
+    with mapped:
+        for offset in range(start, end + 1, DOWNLOAD_CHUNK_SIZE_BYTES):
+            yield mapped[offset:min(offset + DOWNLOAD_CHUNK_SIZE_BYTES, end + 1)]
+
+async def iter_body(response: dict, fill: Optional[CacheFill] = None) -> AsyncIterator[bytes]:
+    """
+    Chunks of an S3 GET response, written to the object cache as well if
+    `fill` is given, which is kept only once the whole body is read
+    """
+    try:
+        body = response['Body']
+        async with body:
+            async for chunk in body.iter_chunks(chunk_size=DOWNLOAD_CHUNK_SIZE_BYTES):
+                BYTES_TOTAL.labels("s3_read").inc(len(chunk))
+                if fill is not None:
+                    await fill.write(chunk)
+                yield chunk
+        if fill is not None:
+            await fill.commit(response["ETag"])
+    finally:
+        if fill is not None:
+            fill.abort()
+
+async def get_image_buffer_generator_s3(uuid: str, extension: str) -> AsyncIterator[bytes]:
+    cached = object_cache.lookup(str(uuid))
+    if cached is not None:
+        for chunk in iter_mapped(cached[0]):
             yield chunk
+        return
+
+    fill = object_cache.begin_fill(str(uuid))
+    try:
+        async with s3_pool.acquire() as s3:
+            # Get the object from S3
+            response = await s3.get_object(Bucket=S3_BUCKET, Key=object_key(uuid, extension))
+            async for chunk in iter_body(response, fill):
+                yield chunk
+    finally:
+        if fill is not None:
+            fill.abort()
+
+@s3_read_retry
+async def fetch_image_buffer(uuid: str, extension: str) -> Tuple[bytes, str]:
+    async with s3_pool.acquire() as s3:
+        # Get the object from S3
+        response = await s3.get_object(Bucket=S3_BUCKET, Key=object_key(uuid, extension))
+
+        body = response['Body']
+        async with body:
+            data = await body.read()
+        BYTES_TOTAL.labels("s3_read").inc(len(data))
+        return data, response["ETag"]
+
+async def get_image_buffer(uuid: str, extension: str, etag: Optional[str] = None) -> bytes:
+    """Whole object, from the object cache if it holds it, with `etag` if given"""
+    return await object_cache.get(str(uuid), etag, lambda: fetch_image_buffer(uuid, extension))
+
+async def get_image_size(uuid: str, extension: str) -> int:
+    size = object_cache.size(str(uuid))
+    if size is not None:
+        return size
+    return await head_image_size(uuid, extension)
+
+@s3_read_retry
+async def head_image_size(uuid: str, extension: str) -> int:
+    async with s3_pool.acquire() as s3:
+        response = await s3.head_object(Bucket=S3_BUCKET, Key=object_key(uuid, extension))
+        return response["ContentLength"]
+
+async def presign_upload(uuid: str, extension: str, mime_type: str, size: int) -> str:
+    """PUT URL for the object, to be sent with Content-Type `mime_type` and Content-Length `size`"""
+    return await s3_pool.presign("put_object", {
+        "Key": object_key(uuid, extension), "ContentType": mime_type, "ContentLength": size})
+
+async def presign_download(uuid: str, extension: str) -> str:
+    return await s3_pool.presign("get_object", {"Key": object_key(uuid, extension)})
+
+async def head_image(uuid: str, extension: str, head_bytes: int) -> Optional[Tuple[int, str, bytes]]:
+    """
+    Size, ETag and first `head_bytes` of a stored object, None if there's none.
+    Just the head is read, from the same version of the object
+    """
+    key = object_key(uuid, extension)
+    async with s3_pool.acquire() as s3:
+        try:
+            response = await s3.head_object(Bucket=S3_BUCKET, Key=key)
+        except ClientError as e:
+            if is_missing(e):
+                return None
+            raise
+
+        size, etag = response["ContentLength"], response["ETag"]
+        if size == 0:
+            return size, etag, b""
+
+        ranged = await s3.get_object(Bucket=S3_BUCKET, Key=key, Range=f"bytes=0-{head_bytes - 1}", IfMatch=etag)
+        body = ranged["Body"]
+        async with body:
+            head = await body.read()
+        BYTES_TOTAL.labels("s3_read").inc(len(head))
+        return size, etag, head
+
+async def delete_image(uuid: str, extension: str):
+    object_cache.discard(str(uuid))
+    async with s3_pool.acquire() as s3:
+        await s3.delete_object(Bucket=S3_BUCKET, Key=object_key(uuid, extension))
+
+def single_range(byte_range: str, size: int) -> Optional[Tuple[int, int]]:
+    """First and last byte of a satisfiable single `bytes=` range of `size` bytes, None for anything else"""
+    unit, _, spec = byte_range.partition("=")
+    first, dash, last = spec.strip().partition("-")
+    if unit.strip() != "bytes" or "," in spec or not dash:
+        return None
+    try:
+        if first:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+        else:
+            # Suffix, last N bytes
+            start, end = max(size - int(last), 0), size - 1
+    except ValueError:
+        return None
+    return (start, end) if start <= end else None
+
+async def get_image_content(
+    uuid: str,
+    extension: str,
+    media_type: str,
+    byte_range: Optional[str] = None,
+    if_none_match: Optional[str] = None,
+    etag: Optional[str] = None
+) -> Response:
+    """
+    Streams object from the object cache, or from S3 as is. Single ranges are
+    served from the cache, other ranges and `if_none_match` are passed through
+    to S3, so partial and conditional reads never pull the whole object.
+    Whole objects read from S3 fill the cache on the way, unless it is being
+    filled already: readers meanwhile go to S3 rather than wait for a client
+    """
+    key = str(uuid)
+    if not if_none_match:
+        cached = object_cache.lookup(key, etag)
+        if cached is not None:
+            mapped, cached_etag = cached
+            size = len(mapped)
+            served = single_range(byte_range, size) if byte_range else (0, size - 1)
+            if served is not None:
+                start, end = served
+                headers = {
+                    "content-length": str(end - start + 1),
+                    "etag": cached_etag,
+                    "accept-ranges": "bytes",
+                }
+                if byte_range:
+                    headers["content-range"] = f"bytes {start}-{end}/{size}"
+                return StreamingResponse(
+                    content=iter_mapped(mapped, start, end),
+                    status_code=206 if byte_range else 200,
+                    media_type=media_type,
+                    headers=headers
+                    )
+            mapped.close()
+
+    fill = object_cache.begin_fill(key) if not byte_range and not if_none_match else None
+
+    params = {"Bucket": S3_BUCKET, "Key": object_key(uuid, extension)}
+    if byte_range:
+        params["Range"] = byte_range
+    if if_none_match:
+        params["IfNoneMatch"] = if_none_match
+
+    # Pool slot is held until streaming is over
+    acquired = s3_pool.acquire()
+    s3 = await acquired.__aenter__()
+
+    try:
+        response = await s3.get_object(**params)
+    except ClientError as e:
+        await acquired.__aexit__(None, None, None)
+        if fill is not None:
+            fill.abort()
+        error = e.response.get("Error", {})
+        if error.get("Code") in ("304", "NotModified"):
+            etag = e.response["ResponseMetadata"]["HTTPHeaders"].get("etag", if_none_match)
+            return Response(status_code=304, headers={"etag": etag})
+        if error.get("Code") == "InvalidRange":
+            return Response(status_code=416)
+        raise
+    except BaseException:
+        await acquired.__aexit__(None, None, None)
+        if fill is not None:
+            fill.abort()
+        raise
+
+    async def iterfile():
+        try:
+            async for chunk in iter_body(response, fill):
+                yield chunk
+        finally:
+            await acquired.__aexit__(None, None, None)
+            if fill is not None:
+                fill.abort()
+
+    headers = {
+        "content-length": str(response["ContentLength"]),
+        "etag": response["ETag"],
+        "accept-ranges": "bytes",
+    }
+    if "ContentRange" in response:
+        headers["content-range"] = response["ContentRange"]
+
     # Return a streaming response
     return StreamingResponse(
         content=iterfile(),
+        status_code=206 if "ContentRange" in response else 200,
         media_type=media_type,
-        headers={ "content-length" : str (response[ "ContentLength" ]), "etag" : response[ "ETag" ]}
+        headers=headers
         )
@@ -0,0 +1,55 @@
+"""
+Uploads of originals running in this process, started as tasks of their own
+so transforms can run alongside them. Transforms handed the original's bytes
+don't wait at all, those reading it from S3 wait here for the upload to end
+"""
+import asyncio
+from time import monotonic
+from typing import Awaitable, Dict
+from uuid import UUID
+
+
+class UploadRegistry:
+    def __init__(self):
+        self._uploads: Dict[UUID, asyncio.Task] = {}
+
+        self.started_total = 0
+        self.waited_total = 0
+        self.wait_seconds_total = 0.0
+
+    def start(self, image_id: UUID, upload: Awaitable) -> asyncio.Task:
+        task = asyncio.create_task(upload)
+        self._uploads[image_id] = task
+        task.add_done_callback(lambda _: self._uploads.pop(image_id, None))
+        self.started_total += 1
+        return task
+
+    async def wait(self, image_id: UUID):
+        """Returns once `image_id` isn't being uploaded by this process, failed uploads included"""
+        task = self._uploads.get(image_id)
+        if task is None:
+            return
+
+        self.waited_total += 1
+        started = monotonic()
+        try:
+            # Waiter being cancelled doesn't cancel the upload
+            await asyncio.wait([task])
+        finally:
+            self.wait_seconds_total += monotonic() - started
+
+    async def close(self):
+        """Lets uploads in flight finish"""
+        if self._uploads:
+            await asyncio.wait(list(self._uploads.values()))
+
+    def stats(self) -> dict:
+        return {
+            "inFlight": len(self._uploads),
+            "started": self.started_total,
+            "waited": self.waited_total,
+            "waitSecondsTotal": round(self.wait_seconds_total, 3),
+        }
+
+
+upload_registry = UploadRegistry()
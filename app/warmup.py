@@ -0,0 +1,106 @@
+"""
+Readiness of the process. Importing the app and starting it connects to
+nothing, DB, S3 and ML clients are created on first use. Resources listed
+in WARMUP are opened in the background on startup instead, so first
+requests don't pay for connecting: /healthz answers as soon as the process
+serves, /readyz once warm-up is over and until shutdown begins
+"""
+import asyncio
+from time import monotonic
+from typing import Dict, List, Optional
+
+from sqlalchemy import text
+
+from .config import DB_POOL_SIZE, S3_BUCKET, WARMUP, WARMUP_DB_CONNECTIONS, WARMUP_RETRY_SECONDS
+from .database import engine
+from .s3 import s3_pool
+from .tasks.ml_client import ml_clients
+
+# Times are counted from import of this module, along with the app's
+PROCESS_STARTED = monotonic()
+
+
+async def warm_db():
+    async def ping():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    # Checked out at once, so each opens a connection of its own
+    await asyncio.gather(*(ping() for _ in range(max(min(WARMUP_DB_CONNECTIONS, DB_POOL_SIZE), 1))))
+
+
+async def warm_s3():
+    async with s3_pool.acquire() as s3:
+        await s3.head_bucket(Bucket=S3_BUCKET)
+
+
+async def warm_ml():
+    for backend in ml_clients.backends.values():
+        try:
+            await backend.warm()
+        except Exception as e:
+            print(f"ML backend {backend.name} not warmed: {e} ({type(e)})")
+
+
+WARMERS = {"db": warm_db, "s3": warm_s3, "ml": warm_ml}
+
+
+class Warmup:
+    def __init__(self, resources: List[str]):
+        unknown = set(resources) - set(WARMERS)
+        if unknown:
+            raise ValueError(f"Unknown WARMUP resources: {', '.join(sorted(unknown))}")
+        self.resources = resources
+        self._task: Optional[asyncio.Task] = None
+        self.closing = False
+
+        self.started_at: Optional[float] = None
+        self.ready_at: Optional[float] = None
+        # Resource -> seconds it took to warm, and last error of those not warmed yet
+        self.warmed: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_at is not None and not self.closing
+
+    def start(self):
+        self.started_at = monotonic()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        await asyncio.gather(*(self._warm(resource) for resource in self.resources))
+        self.ready_at = monotonic()
+        print(f"Ready in {self.ready_at - PROCESS_STARTED:.2f}s, warmed: {self.warmed}")
+
+    async def _warm(self, resource: str):
+        started = monotonic()
+        while True:
+            try:
+                await WARMERS[resource]()
+                break
+            except Exception as e:
+                print(f"Warming {resource} failed, retrying in {WARMUP_RETRY_SECONDS}s: {e} ({type(e)})")
+                self.errors[resource] = f"{type(e).__name__}: {e}"
+                await asyncio.sleep(WARMUP_RETRY_SECONDS)
+        self.warmed[resource] = round(monotonic() - started, 3)
+        self.errors.pop(resource, None)
+
+    async def close(self):
+        """Not ready anymore, so traffic drains while shutting down"""
+        self.closing = True
+        if self._task is not None:
+            self._task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "resources": self.resources,
+            "warmedSeconds": self.warmed,
+            "errors": self.errors,
+            "startupSeconds": round(self.started_at - PROCESS_STARTED, 3) if self.started_at is not None else None,
+            "readySeconds": round(self.ready_at - PROCESS_STARTED, 3) if self.ready_at is not None else None,
+        }
+
+
+warmup = Warmup([resource.strip() for resource in WARMUP.split(",") if resource.strip()])
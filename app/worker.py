@@ -0,0 +1,118 @@
+"""
+Standalone transform worker, run as `python -m app.worker`.
+Any number of these can run next to API replicas, jobs are shared
+through the transform_job table
+"""
+import asyncio
+import os
+import socket
+from typing import Dict
+
+from prometheus_client import start_http_server
+
+from .config import METRICS_WORKER_PORT, WORKER_CONCURRENCY, WORKER_CLAIM_BATCH, WORKER_POLL_INTERVAL
+from .database import SessionLocal, engine
+from .models import TransformJob
+from .object_cache import object_cache
+from .s3 import s3_pool
+from .schemas import ModelType, OperationType
+from .tasks.ml_client import ml_clients
+from .tasks.preprocess import preprocessor
+from .tasks.queue import claim_jobs, extend_leases, finish_job, requeue_expired
+from .tasks.transform import create_transformed_image, fail_transform
+from .tasks.upload import is_missing
+
+
+async def _claim(worker_id: str, model: ModelType, limit: int):
+    async with SessionLocal() as db:
+        jobs = await claim_jobs(db, worker_id, model, limit)
+        # Lease is a server-side expression, load it as set
+        for job in jobs:
+            await db.refresh(job)
+        return jobs
+
+
+async def _requeue_expired() -> int:
+    async with SessionLocal() as db:
+        return await requeue_expired(db)
+
+
+async def _extend_leases(worker_id: str, job_ids):
+    async with SessionLocal() as db:
+        await extend_leases(db, worker_id, job_ids)
+
+
+async def _finish(job_id, status: str):
+    async with SessionLocal() as db:
+        await finish_job(db, job_id, status)
+
+
+class Worker:
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.running: Dict[ModelType, Dict] = {model: {} for model in ModelType}
+
+    async def run_job(self, job: TransformJob):
+        model = ModelType(job.modelType)
+        task = OperationType(job.operationType)
+        try:
+            # ML failures are handled inside, marking the image as error
+            await create_transformed_image(job.fromImageId, job.extension, job.imageId, task, model)
+        except Exception as e:
+            print(f"Transform job {job.jobId} failed: {e} ({type(e)})")
+            if is_missing(e):
+                # Parent is gone, no later attempt would find it
+                await fail_transform(job.imageId, task, model, "error")
+                await _finish(job.jobId, "failed")
+            # Otherwise lease is left to expire, so the job is retried or failed by attempts
+            return
+        finally:
+            self.running[model].pop(job.jobId, None)
+
+        await _finish(job.jobId, "done")
+
+    async def poll(self) -> int:
+        await _requeue_expired()
+
+        claimed = 0
+        for model in ModelType:
+            free = WORKER_CONCURRENCY[model] - len(self.running[model])
+            if free <= 0:
+                continue
+
+            jobs = await _claim(self.worker_id, model, min(free, WORKER_CLAIM_BATCH))
+            for job in jobs:
+                self.running[model][job.jobId] = asyncio.create_task(self.run_job(job))
+            claimed += len(jobs)
+
+        job_ids = [job_id for running in self.running.values() for job_id in running]
+        await _extend_leases(self.worker_id, job_ids)
+
+        return claimed
+
+    async def run(self):
+        print(f"Transform worker {self.worker_id} started")
+        if METRICS_WORKER_PORT:
+            start_http_server(METRICS_WORKER_PORT)
+        await s3_pool.start()
+        try:
+            while True:
+                try:
+                    claimed = await self.poll()
+                except Exception as e:
+                    print(f"Transform worker poll error: {e} ({type(e)})")
+                    claimed = 0
+
+                # Keep draining while there is a backlog
+                if claimed < WORKER_CLAIM_BATCH:
+                    await asyncio.sleep(WORKER_POLL_INTERVAL)
+        finally:
+            await s3_pool.close()
+            await ml_clients.close()
+            preprocessor.close()
+            object_cache.close()
+            await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(Worker().run())
@@ -0,0 +1,110 @@
+"""
+Micro-benchmark of the streaming ML response decoder.
+
+Builds multi-megabyte synthetic responses in both backend shapes, splits them
+at random chunk boundaries and compares the streaming decoder with decoding
+the whole buffered body at once. Run from repo root:
+
+    python -m bench.decoder_bench --sizes 1 4 12 --repeat 5
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import tracemalloc
+from hashlib import sha256
+from time import perf_counter
+
+from app.tasks.decoder import AI24_IMAGE_PATH, PREDICTIONS_PATH, Base64JsonValueDecoder
+
+
+def make_response(shape: str, image: bytes, escape_slashes: bool) -> bytes:
+    encoded = base64.b64encode(image).decode()
+    if shape == "internal":
+        body = json.dumps({"predictions": encoded})
+    else:
+        body = json.dumps({"success": True, "code": 200, "message": "", "error": "",
+                           "data": {"image": encoded}})
+    if escape_slashes:
+        body = body.replace("/", "\\/")
+    return body.encode()
+
+
+def split(body: bytes, rng: random.Random, max_chunk: int) -> list:
+    chunks = []
+    pos = 0
+    while pos < len(body):
+        # Mostly network-sized chunks, some tiny ones to hit boundary cases
+        size = rng.choice([1, 2, 3, rng.randint(1, max_chunk), rng.randint(max_chunk // 2, max_chunk)])
+        chunks.append(body[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def run_streaming(chunks: list, path) -> bytes:
+    # Hashing sink, so peak memory is the decoder's own, as with a file sink
+    out = sha256()
+    decoder = Base64JsonValueDecoder(path, out.update)
+    for chunk in chunks:
+        decoder.feed(chunk)
+    decoder.close()
+    return out.digest()
+
+
+def run_buffered(chunks: list, shape: str) -> bytes:
+    body = json.loads(b"".join(chunks))
+    value = body["predictions"] if shape == "internal" else body["data"]["image"]
+    return base64.b64decode(value)
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    started = perf_counter()
+    result = fn(*args)
+    elapsed = perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 4, 12], help="Image sizes, MB")
+    parser.add_argument("--max-chunk", type=int, default=65536)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'shape':<10}{'MB':>6}{'chunks':>9}{'stream MB/s':>13}{'stream peak MB':>16}"
+          f"{'buffered MB/s':>15}{'buffered peak MB':>18}")
+
+    for size_mb in args.sizes:
+        image = os.urandom(int(size_mb * 1_000_000))
+        digest = sha256(image).digest()
+        for shape, path in (("internal", PREDICTIONS_PATH), ("24ai", AI24_IMAGE_PATH)):
+            body = make_response(shape, image, escape_slashes=shape == "24ai")
+            stream_times, buffered_times = [], []
+            stream_peak = buffered_peak = 0
+
+            for _ in range(args.repeat):
+                chunks = split(body, rng, args.max_chunk)
+
+                result, elapsed, peak = measure(run_streaming, chunks, path)
+                assert result == digest, "streaming decoder output mismatch"
+                stream_times.append(elapsed)
+                stream_peak = max(stream_peak, peak)
+
+                result, elapsed, peak = measure(run_buffered, chunks, shape)
+                assert result == image, "buffered decoder output mismatch"
+                buffered_times.append(elapsed)
+                buffered_peak = max(buffered_peak, peak)
+
+            print(f"{shape:<10}{size_mb:>6}{len(chunks):>9}"
+                  f"{len(body) / 1e6 / min(stream_times):>13.1f}{stream_peak / 1e6:>16.1f}"
+                  f"{len(body) / 1e6 / min(buffered_times):>15.1f}{buffered_peak / 1e6:>18.1f}")
+
+
+if __name__ == "__main__":
+    main()
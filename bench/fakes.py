@@ -0,0 +1,244 @@
+"""
+Local stand-ins for the services the pipeline talks to, for benchmarks:
+an in-memory S3 with just the calls the app makes, an ML server answering
+in both backend response shapes, and SQLite in place of Postgres.
+Servers run on their own event loop threads, away from the app's loop
+"""
+import asyncio
+import json
+import threading
+from hashlib import md5
+from typing import Dict, Optional
+from uuid import uuid4
+
+from aiohttp import web
+
+XML = "application/xml"
+
+
+def _error(status: int, code: str, message: str) -> web.Response:
+    body = f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code><Message>{message}</Message></Error>'
+    return web.Response(status=status, body=body, content_type=XML)
+
+
+def _etag(data: bytes) -> str:
+    return f'"{md5(data).hexdigest()}"'
+
+
+class FakeS3:
+    """
+    Path-style S3 holding objects in memory: put, head, get with ranges and
+    If-None-Match, multipart uploads. Buckets are implied by keys
+    """
+
+    def __init__(self):
+        self.objects: Dict[str, bytes] = {}
+        self.uploads: Dict[str, Dict[int, bytes]] = {}
+        self.requests_total = 0
+
+        self.app = web.Application(client_max_size=1024 ** 3)
+        self.app.router.add_route("*", "/{bucket}", self.bucket)
+        self.app.router.add_route("*", "/{bucket}/{key:.*}", self.object)
+
+    async def bucket(self, request: web.Request) -> web.Response:
+        return web.Response(status=200)
+
+    async def object(self, request: web.Request) -> web.StreamResponse:
+        self.requests_total += 1
+        key = request.match_info["bucket"] + "/" + request.match_info["key"]
+        query = request.query
+
+        if request.method == "PUT":
+            data = await request.read()
+            if "uploadId" in query:
+                self.uploads[query["uploadId"]][int(query["partNumber"])] = data
+            else:
+                self.objects[key] = data
+            return web.Response(status=200, headers={"ETag": _etag(data)})
+
+        if request.method == "POST" and "uploads" in query:
+            upload_id = uuid4().hex
+            self.uploads[upload_id] = {}
+            body = ('<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult>'
+                    f'<Bucket>{request.match_info["bucket"]}</Bucket><Key>{request.match_info["key"]}</Key>'
+                    f'<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>')
+            return web.Response(body=body, content_type=XML)
+
+        if request.method == "POST" and "uploadId" in query:
+            parts = self.uploads.pop(query["uploadId"])
+            data = b"".join(parts[number] for number in sorted(parts))
+            self.objects[key] = data
+            body = ('<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult>'
+                    f'<Key>{request.match_info["key"]}</Key><ETag>{_etag(data)}</ETag>'
+                    '</CompleteMultipartUploadResult>')
+            return web.Response(body=body, content_type=XML)
+
+        if request.method == "DELETE":
+            if "uploadId" in query:
+                self.uploads.pop(query["uploadId"], None)
+            else:
+                self.objects.pop(key, None)
+            return web.Response(status=204)
+
+        data = self.objects.get(key)
+        if data is None:
+            return _error(404, "NoSuchKey", "The specified key does not exist.")
+        etag = _etag(data)
+        headers = {"ETag": etag, "Accept-Ranges": "bytes", "Content-Type": "binary/octet-stream"}
+
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers=headers)
+
+        status = 200
+        byte_range = request.headers.get("Range")
+        if byte_range:
+            start, _, end = byte_range.removeprefix("bytes=").partition("-")
+            if not start:
+                start, end = max(len(data) - int(end), 0), len(data) - 1
+            else:
+                start, end = int(start), min(int(end), len(data) - 1) if end else len(data) - 1
+            if start >= len(data):
+                return _error(416, "InvalidRange", "The requested range is not satisfiable")
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+            data = data[start:end + 1]
+            status = 206
+
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(data))
+            return web.Response(status=status, headers=headers)
+        return web.Response(status=status, body=data, headers=headers)
+
+
+class FakeML:
+    """
+    ML backend echoing the input image back, `{"predictions": ...}` like the
+    internal one or `{"data": {"image": ...}}` on `remove-background` like
+    24ai. Answers after `latency` seconds, base64 goes out in `chunk_size`
+    chunks with `chunk_delay` seconds between them
+    """
+
+    def __init__(self, latency: float, chunk_size: int, chunk_delay: float):
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.requests_total = 0
+        self.bytes_out_total = 0
+
+        self.app = web.Application(client_max_size=1024 ** 3)
+        self.app.router.add_post("/{path:.*}", self.predict)
+
+    async def predict(self, request: web.Request) -> web.StreamResponse:
+        self.requests_total += 1
+        image = json.loads(await request.read())["image"].encode()
+        await asyncio.sleep(self.latency)
+
+        if request.path.endswith("remove-background"):
+            prefix, suffix = b'{"success": true, "data": {"image": "', b'"}}'
+        else:
+            prefix, suffix = b'{"predictions": "', b'"}'
+
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        await response.write(prefix)
+        for offset in range(0, len(image), self.chunk_size):
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+            await response.write(image[offset:offset + self.chunk_size])
+        await response.write(suffix)
+        await response.write_eof()
+        self.bytes_out_total += len(prefix) + len(image) + len(suffix)
+        return response
+
+
+class ServerThread(threading.Thread):
+    """Serves an aiohttp app on 127.0.0.1 from its own thread and event loop"""
+
+    def __init__(self, app: web.Application, port: int = 0):
+        super().__init__(daemon=True)
+        self.app = app
+        self.port = port
+        self.started = threading.Event()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        runner = web.AppRunner(self.app, access_log=None)
+        self.loop.run_until_complete(runner.setup())
+        self.loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", self.port).start())
+        self.port = runner.addresses[0][1]
+        self.started.set()
+        self.loop.run_forever()
+
+    def start(self) -> "ServerThread":
+        super().start()
+        self.started.wait()
+        return self
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def use_sqlite():
+    """
+    Lets the Postgres-typed app run on SQLite. Must be called before `app` is
+    imported. UUIDs are stored as text, pg_notify hands status events straight
+    to the status hub of this process and bulk status reads use IN instead of
+    an array parameter
+    """
+    from sqlalchemy import event, select
+    from sqlalchemy.dialects.postgresql import UUID
+    from sqlalchemy.ext import asyncio as sqlalchemy_asyncio
+    from sqlalchemy.ext.compiler import compiles
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+    @compiles(UUID, "sqlite")
+    def compile_uuid(element, compiler, **kwargs):
+        return "CHAR(32)"
+
+    create_async_engine = sqlalchemy_asyncio.create_async_engine
+    loops = []
+
+    def pg_notify(channel: str, payload: str) -> str:
+        from app.notify import status_hub
+        if loops:
+            loops[0].call_soon_threadsafe(status_hub.dispatch, json.loads(payload))
+        return ""
+
+    def create_sqlite_engine(url, **kwargs):
+        # Pool sizing applies, aiosqlite would default to NullPool
+        engine = create_async_engine(url, poolclass=AsyncAdaptedQueuePool, **kwargs)
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def register(connection, record):
+            connection.create_function("pg_notify", 2, pg_notify)
+            # Readers don't wait for writers
+            cursor = connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.close()
+
+        return engine
+
+    sqlalchemy_asyncio.create_async_engine = create_sqlite_engine
+
+    from app import crud
+    from app.main import app
+    from app.models import Image
+
+    @app.on_event("startup")
+    async def remember_loop():
+        loops.append(asyncio.get_running_loop())
+
+    async def get_image_statuses(db, image_ids, user_id):
+        result = await db.execute(
+            select(Image.imageId, Image.status)
+            .where(Image.imageId.in_(list(image_ids)), Image.userId == user_id)
+        )
+        return {row.imageId: row.status for row in result}
+
+    crud.get_image_statuses = get_image_statuses
@@ -0,0 +1,164 @@
+"""
+Benchmark of the image listing on a table seeded with millions of rows.
+
+Seeds `--rows` images spread over many users plus `--user-rows` owned by
+one heavy user (half originals, half their children), then compares loading
+the heavy user's whole listing at once, as before pagination, with keyset
+pages at the start and deep into the listing. Needs Postgres (DATABASE_URL),
+seeded rows are kept between runs unless `--cleanup`. Run from repo root:
+
+    python -m bench.list_bench --rows 2000000 --user-rows 50000 --repeat 5
+"""
+import argparse
+import asyncio
+import statistics
+import tracemalloc
+from time import perf_counter
+
+from sqlalchemy import func, select, text
+
+from app import crud
+from app.database import SessionLocal, engine
+from app.models import Base, Image
+
+HEAVY_USER = "bench-heavy"
+
+SEED_USERS = text("""
+    INSERT INTO image (image_id, type, model_type, created_at, mime_type, user_id, status)
+    SELECT gen_random_uuid(), 'original', 'internal', now() - n * interval '1 second',
+           'image/png', 'bench-user-' || (n % :users),
+           (ARRAY['ready', 'processing', 'error']::image_status[])[1 + n % 3]
+    FROM generate_series(1, :rows) AS n
+""")
+
+SEED_HEAVY_ORIGINALS = text("""
+    INSERT INTO image (image_id, type, model_type, created_at, mime_type, user_id, status)
+    SELECT gen_random_uuid(), 'original', 'internal', now() - n * interval '1 second',
+           'image/png', :user, 'ready'
+    FROM generate_series(1, :rows) AS n
+""")
+
+SEED_HEAVY_CHILDREN = text("""
+    INSERT INTO image (image_id, type, model_type, created_at, mime_type, user_id, from_image_id, status)
+    SELECT gen_random_uuid(), 'background_remove', 'internal', created_at + interval '1 millisecond',
+           mime_type, user_id, image_id, 'ready'
+    FROM image WHERE user_id = :user AND type = 'original'
+""")
+
+
+async def seed(rows: int, user_rows: int, users: int):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+        seeded = await conn.scalar(select(func.count()).select_from(Image).where(Image.userId == HEAVY_USER))
+        if seeded:
+            print(f"Using {seeded} seeded rows of {HEAVY_USER}")
+            return
+
+        started = perf_counter()
+        await conn.execute(SEED_USERS, {"rows": rows, "users": users})
+        await conn.execute(SEED_HEAVY_ORIGINALS, {"rows": user_rows // 2, "user": HEAVY_USER})
+        await conn.execute(SEED_HEAVY_CHILDREN, {"user": HEAVY_USER})
+        await conn.execute(text("ANALYZE image"))
+        print(f"Seeded {rows + user_rows} rows in {perf_counter() - started:.1f}s")
+
+
+async def cleanup():
+    async with engine.begin() as conn:
+        # Children first, they reference parents
+        await conn.execute(text("DELETE FROM image WHERE user_id LIKE 'bench-%' AND from_image_id IS NOT NULL"))
+        await conn.execute(text("DELETE FROM image WHERE user_id LIKE 'bench-%'"))
+
+
+async def load_everything():
+    """Listing as it was: every image of the user with children joined"""
+    async with SessionLocal() as db:
+        result = await db.scalars(select(Image).where(Image.userId == HEAVY_USER))
+        return len(result.unique().all())
+
+
+async def load_page(limit: int, after=None, **filters):
+    async with SessionLocal() as db:
+        images = await crud.list_images(db, HEAVY_USER, limit, after, **filters)
+        children = await crud.list_children(db, HEAVY_USER, [image.imageId for image in images])
+        return len(images) + len(children)
+
+
+async def cursor_at(limit: int, pages: int):
+    after = None
+    async with SessionLocal() as db:
+        for _ in range(pages):
+            images = await crud.list_images(db, HEAVY_USER, limit, after)
+            if not images:
+                break
+            after = (images[-1].createdAt, images[-1].imageId)
+    return after
+
+
+async def measure(repeat: int, fn, *args, **kwargs):
+    times = []
+    peak = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        started = perf_counter()
+        rows = await fn(*args, **kwargs)
+        times.append(perf_counter() - started)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return rows, statistics.median(times), peak
+
+
+async def explain(limit: int):
+    async with engine.connect() as conn:
+        query = (
+            select(*crud.LIST_COLUMNS)
+            .where(Image.userId == HEAVY_USER)
+            .order_by(Image.createdAt.desc(), Image.imageId.desc())
+            .limit(limit)
+        )
+        compiled = query.compile(engine.sync_engine, compile_kwargs={"literal_binds": True})
+        plan = await conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {compiled}"))
+        print("\n".join(row[0] for row in plan))
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2_000_000, help="Rows of other users")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--user-rows", type=int, default=50_000, help="Rows of the heavy user")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--deep-pages", type=int, default=200, help="Pages to skip for the deep page case")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--skip-full", action="store_true", help="Skip unpaginated listing")
+    parser.add_argument("--explain", action="store_true")
+    parser.add_argument("--cleanup", action="store_true", help="Delete seeded rows and exit")
+    args = parser.parse_args()
+
+    try:
+        if args.cleanup:
+            await cleanup()
+            return
+
+        await seed(args.rows, args.user_rows, args.users)
+
+        cases = []
+        if not args.skip_full:
+            cases.append(("unpaginated", load_everything, (), {}))
+        cases.append(("first page", load_page, (args.page_size,), {}))
+        deep = await cursor_at(args.page_size, args.deep_pages)
+        cases.append((f"page {args.deep_pages + 1}", load_page, (args.page_size, deep), {}))
+        cases.append(("filtered page", load_page, (args.page_size,), {"status": "ready", "type": "original"}))
+
+        print(f"{'case':<16}{'rows':>9}{'median ms':>12}{'peak MB':>10}")
+        for name, fn, fn_args, fn_kwargs in cases:
+            rows, elapsed, peak = await measure(args.repeat, fn, *fn_args, **fn_kwargs)
+            print(f"{name:<16}{rows:>9}{elapsed * 1000:>12.1f}{peak / 1e6:>10.1f}")
+
+        if args.explain:
+            await explain(args.page_size)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,319 @@
+"""
+End-to-end benchmark of the image pipeline against local stand-ins.
+
+Starts the fake S3 and ML servers from `bench.fakes`, serves the app with
+uvicorn on a local port and drives it over HTTP, `--images` requests per
+stage, `--concurrency` at a time:
+
+    upload     POST /image/stream, until the original is stored
+    transform  POST /image/{imageId}/child, until the child is ready
+    download   GET /image/{imageId}/download/raw of the child, whole body
+    pipeline   POST /image/stream with operationType, until the child is ready
+
+Readiness is polled with GET /image/{imageId}/status every `--poll-interval`.
+Each stage reports p50/p95/p99 latency, images/sec and peak RSS of the
+process, which holds the fakes and the load generator too, so compare RSS
+growth between runs rather than absolute numbers. Results go to `--output`
+as JSON; with `--baseline` a previous result file is compared against.
+
+24ai is served by a fake of its own answering after `--ml-24ai-latency`
+seconds when that's given, to see `--model auto` routing and hedging
+between a fast and a slow backend.
+
+Postgres from DATABASE_URL is used by default, `--sqlite` runs on a SQLite
+file instead (needs aiosqlite). Run from repo root:
+
+    python -m bench.pipeline_bench --sqlite --images 200 --concurrency 16 --output pipeline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+from datetime import datetime
+from io import BytesIO
+from time import perf_counter, sleep
+from typing import Awaitable, Callable, List, Optional
+
+import httpx
+import numpy as np
+from PIL import Image as PILImage
+
+from bench.fakes import FakeML, FakeS3, ServerThread, use_sqlite
+
+USER = {"X-User-Id": "bench-pipeline"}
+STAGES = ("upload", "transform", "download", "pipeline")
+
+
+class RssSampler(threading.Thread):
+    """Peak resident memory since last `reset()`, sampled from /proc"""
+
+    def __init__(self, interval: float = 0.02):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.start_rss = self.peak = self.current()
+
+    def current(self) -> int:
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * self.page_size
+        except OSError:
+            # Peak of the whole process lifetime where there's no /proc
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def reset(self):
+        self.start_rss = self.peak = self.current()
+
+    def run(self):
+        while True:
+            self.peak = max(self.peak, self.current())
+            sleep(self.interval)
+
+
+def make_image(width: int, height: int, seed: int) -> bytes:
+    """Noise PNG, so every image is distinct and doesn't compress away"""
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    output = BytesIO()
+    PILImage.fromarray(pixels).save(output, format="PNG", compress_level=1)
+    return output.getvalue()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+async def run_stage(
+    name: str,
+    count: int,
+    concurrency: int,
+    call: Callable[[int], Awaitable[None]],
+    sampler: RssSampler
+) -> dict:
+    latencies = []
+    errors = 0
+    limit = asyncio.Semaphore(concurrency)
+
+    async def timed(index: int):
+        nonlocal errors
+        async with limit:
+            started = perf_counter()
+            try:
+                await call(index)
+            except Exception as e:
+                errors += 1
+                print(f"{name} #{index} failed: {e!r}", file=sys.stderr)
+                return
+            latencies.append(perf_counter() - started)
+
+    sampler.reset()
+    started = perf_counter()
+    await asyncio.gather(*(timed(index) for index in range(count)))
+    elapsed = perf_counter() - started
+
+    latencies.sort()
+    result = {
+        "count": count,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "imagesPerSecond": round(len(latencies) / elapsed, 2),
+        "peakRssMb": round(sampler.peak / 2 ** 20, 1),
+        "rssGrowthMb": round((sampler.peak - sampler.start_rss) / 2 ** 20, 1),
+    }
+    if latencies:
+        result.update({
+            "meanMs": round(statistics.fmean(latencies) * 1000, 1),
+            "p50Ms": round(percentile(latencies, 0.50) * 1000, 1),
+            "p95Ms": round(percentile(latencies, 0.95) * 1000, 1),
+            "p99Ms": round(percentile(latencies, 0.99) * 1000, 1),
+        })
+    return result
+
+
+async def wait_ready(client: httpx.AsyncClient, image_id: str, poll_interval: float, timeout: float):
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        response = await client.get(f"/image/{image_id}/status", headers=USER)
+        response.raise_for_status()
+        status = response.json()["status"]
+        if status == "ready":
+            return
+        if status == "error":
+            raise RuntimeError(f"Image {image_id} failed")
+        await asyncio.sleep(poll_interval)
+    raise TimeoutError(f"Image {image_id} not ready in {timeout}s")
+
+
+async def drive(args, base_url: str, images: List[bytes], pipeline_images: List[bytes], sampler: RssSampler) -> dict:
+    transform = {"operationType": args.operation, "modelType": args.model}
+    originals: List[Optional[str]] = [None] * args.images
+    children: List[Optional[str]] = [None] * args.images
+    results = {}
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        async def upload(index: int):
+            response = await client.post("/image/stream", content=images[index], headers=USER)
+            response.raise_for_status()
+            originals[index] = response.json()["imageId"]
+
+        async def child(index: int):
+            response = await client.post(f"/image/{originals[index]}/child", json=transform, headers=USER)
+            response.raise_for_status()
+            children[index] = response.json()["imageId"]
+            await wait_ready(client, children[index], args.poll_interval, args.timeout)
+
+        async def download(index: int):
+            async with client.stream("GET", f"/image/{children[index]}/download/raw", headers=USER) as response:
+                response.raise_for_status()
+                async for _ in response.aiter_raw():
+                    pass
+
+        async def pipeline(index: int):
+            response = await client.post("/image/stream", params=transform, content=pipeline_images[index], headers=USER)
+            response.raise_for_status()
+            await wait_ready(client, response.json()["children"][0]["imageId"], args.poll_interval, args.timeout)
+
+        calls = {"upload": upload, "transform": child, "download": download, "pipeline": pipeline}
+        for stage in args.stages:
+            results[stage] = await run_stage(stage, args.images, args.concurrency, calls[stage], sampler)
+            print(f"{stage:<10}" + "  ".join(f"{key} {value}" for key, value in results[stage].items()))
+
+    return results
+
+
+def compare(results: dict, baseline_path: str):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)["stages"]
+    print(f"\n{'vs baseline':<12}{'p50':>9}{'p95':>9}{'p99':>9}{'img/s':>9}{'rss+':>9}")
+    for stage, result in results.items():
+        before = baseline.get(stage)
+        if before is None:
+            continue
+        cells = []
+        for key in ("p50Ms", "p95Ms", "p99Ms", "imagesPerSecond", "rssGrowthMb"):
+            if key in result and before.get(key):
+                cells.append(f"{(result[key] / before[key] - 1) * 100:>+8.1f}%")
+            else:
+                cells.append(f"{'-':>9}")
+        print(f"{stage:<12}" + "".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=100, help="Requests per stage")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES),
+                        help="transform and download work on images of upload")
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--operation", choices=("background_remove", "super_resolution"), default="background_remove")
+    parser.add_argument("--model", choices=("internal", "24ai", "auto"), default="internal")
+    parser.add_argument("--ml-latency", type=float, default=0.2, help="Seconds before ML answers")
+    parser.add_argument("--ml-24ai-latency", type=float, help="Seconds before 24ai answers, if not as internal")
+    parser.add_argument("--ml-chunk-size", type=int, default=64 * 1024, help="Bytes per ML response chunk")
+    parser.add_argument("--ml-chunk-delay", type=float, default=0.0, help="Seconds between ML response chunks")
+    parser.add_argument("--poll-interval", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--sqlite", action="store_true", help="Run on a SQLite file instead of DATABASE_URL")
+    parser.add_argument("--output", help="JSON results file")
+    parser.add_argument("--baseline", help="Previous JSON results to compare with")
+    args = parser.parse_args()
+
+    s3 = FakeS3()
+    ml = FakeML(args.ml_latency, args.ml_chunk_size, args.ml_chunk_delay)
+    s3_server = ServerThread(s3.app).start()
+    ml_server = ServerThread(ml.app).start()
+    ml_24ai, ml_24ai_server = ml, ml_server
+    if args.ml_24ai_latency is not None:
+        ml_24ai = FakeML(args.ml_24ai_latency, args.ml_chunk_size, args.ml_chunk_delay)
+        ml_24ai_server = ServerThread(ml_24ai.app).start()
+
+    # App settings are read on import
+    os.environ.update({
+        "S3_ENDPOINT_URL": s3_server.url,
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "ML_SSL_VERIFY": "false",
+        "ML_24AI_TOKEN": "bench",
+    })
+    # All load comes from one user, per-user limits would be what's measured
+    for name in ("RATE_LIMIT_REQUESTS_PER_SECOND", "RATE_LIMIT_UPLOAD_BYTES_PER_SECOND", "TRANSFORM_USER_CONCURRENCY"):
+        os.environ.setdefault(name, "0")
+    if args.sqlite:
+        database = os.path.join(tempfile.mkdtemp(prefix="pipeline-bench-"), "bench.sqlite")
+        os.environ["DATABASE_URL"] = f"sqlite:///{database}"
+        os.environ["ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{database}"
+        # No LISTEN on SQLite, status events come from pg_notify stand-in
+        os.environ.setdefault("NOTIFY_RECONNECT_SECONDS", "3600")
+        use_sqlite()
+
+    import uvicorn
+    from app import migrate
+    from app.main import app
+    from app.schemas import ModelType
+    from app.tasks.ml_client import ml_clients
+    from app.tasks.ml_router import ml_router
+
+    # On the app's loop, as the engine is bound to it, ahead of its own startup
+    app.router.on_startup.insert(0, migrate.migrate)
+
+    ml_clients.get(ModelType.internal).url = f"{ml_server.url}/v1/models/bench:predict"
+    ml_clients.get(ModelType.ai24).url = f"{ml_24ai_server.url}/api/v1/remove-background"
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=free_port(), log_level="warning"))
+    app_thread = threading.Thread(target=server.run, daemon=True)
+    app_thread.start()
+    while not server.started:
+        sleep(0.05)
+
+    # Pipeline gets images of its own, transforms of uploaded ones would be cache hits
+    images = [make_image(args.width, args.height, seed) for seed in range(args.images)]
+    pipeline_images = [make_image(args.width, args.height, args.images + seed) for seed in range(args.images)] \
+        if "pipeline" in args.stages else []
+    sampler = RssSampler()
+    sampler.start()
+
+    try:
+        results = asyncio.run(drive(args, f"http://127.0.0.1:{server.config.port}", images, pipeline_images, sampler))
+    finally:
+        server.should_exit = True
+        app_thread.join(10)
+        s3_server.stop()
+        ml_server.stop()
+        if ml_24ai_server is not ml_server:
+            ml_24ai_server.stop()
+
+    report = {
+        "startedAt": datetime.now().isoformat(),
+        "config": vars(args),
+        "stages": results,
+        "fakes": {"s3Requests": s3.requests_total, "mlRequests": ml.requests_total, "mlBytesOut": ml.bytes_out_total},
+    }
+    if ml_24ai is not ml:
+        report["fakes"].update({"ml24aiRequests": ml_24ai.requests_total, "ml24aiBytesOut": ml_24ai.bytes_out_total})
+    if args.model == "auto":
+        report["routing"] = ml_router.stats()
+        print(f"Routing: {json.dumps(report['routing'])}")
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+        print(f"Results written to {args.output}")
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
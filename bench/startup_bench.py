@@ -0,0 +1,157 @@
+"""
+Benchmark of API process cold start against local stand-ins.
+
+Starts the fake S3 from `bench.fakes`, migrates the schema once, then
+spawns a fresh API process `--runs` times per `--warmup` setting and
+measures from spawn until:
+
+    healthz  GET /healthz is answered, the process serves
+    readyz   GET /readyz answers 200, resources in WARMUP are open
+    first    GET /image, the first API request, is answered once ready
+             (its own latency is reported as firstRequestMs)
+
+Each `--warmup` value is a WARMUP setting, "" for none. Postgres from
+DATABASE_URL is used by default, `--sqlite` runs on a SQLite file instead
+(needs aiosqlite). Run from repo root:
+
+    python -m bench.startup_bench --sqlite --runs 5 --warmup "" db,s3 --output startup.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from time import perf_counter, sleep
+
+import httpx
+
+from bench.fakes import FakeS3, ServerThread, use_sqlite
+from bench.pipeline_bench import free_port, percentile
+
+USER = {"X-User-Id": "bench-startup"}
+METRICS = ("healthzMs", "readyzMs", "firstMs", "firstRequestMs")
+
+
+def child(args):
+    """Runs in the spawned process: migrates or serves the app"""
+    if args.sqlite:
+        use_sqlite()
+    if args.child == "migrate":
+        from app import migrate
+        asyncio.run(migrate.main())
+        return
+
+    import uvicorn
+    from app.main import app
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def spawn(args, mode: str, env: dict, port: int = 0) -> subprocess.Popen:
+    command = [sys.executable, "-m", "bench.startup_bench", "--child", mode, "--port", str(port)]
+    if args.sqlite:
+        command.append("--sqlite")
+    return subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_for(client: httpx.Client, path: str, deadline: float, status: int = 200):
+    while perf_counter() < deadline:
+        try:
+            if client.get(path).status_code == status:
+                return
+        except httpx.TransportError:
+            pass
+        sleep(0.005)
+    raise TimeoutError(f"{path} not answering {status}")
+
+
+def measure(args, env: dict) -> dict:
+    port = free_port()
+    started = perf_counter()
+    process = spawn(args, "serve", env, port)
+    deadline = started + args.timeout
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=args.timeout) as client:
+            wait_for(client, "/healthz", deadline)
+            healthz = perf_counter()
+            wait_for(client, "/readyz", deadline)
+            readyz = perf_counter()
+            client.get("/image", headers=USER).raise_for_status()
+            first = perf_counter()
+    finally:
+        process.terminate()
+        process.wait(10)
+
+    return {
+        "healthzMs": (healthz - started) * 1000,
+        "readyzMs": (readyz - started) * 1000,
+        "firstMs": (first - started) * 1000,
+        "firstRequestMs": (first - readyz) * 1000,
+    }
+
+
+def summarize(runs: list) -> dict:
+    result = {"runs": len(runs)}
+    for metric in METRICS:
+        values = sorted(run[metric] for run in runs)
+        result[f"{metric[:-2]}P50Ms"] = round(percentile(values, 0.50), 1)
+        result[f"{metric[:-2]}MaxMs"] = round(values[-1], 1)
+        result[f"{metric[:-2]}MeanMs"] = round(statistics.fmean(values), 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5, help="Process starts per warm-up setting")
+    parser.add_argument("--warmup", nargs="+", default=["", "db,s3"], help="WARMUP settings compared")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds for a process to get ready")
+    parser.add_argument("--sqlite", action="store_true", help="Run on a SQLite file instead of DATABASE_URL")
+    parser.add_argument("--output", help="JSON results file")
+    parser.add_argument("--child", choices=("migrate", "serve"), help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    s3 = FakeS3()
+    s3_server = ServerThread(s3.app).start()
+    env = {
+        **os.environ,
+        "S3_ENDPOINT_URL": s3_server.url,
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "PYTHONPATH": os.getcwd(),
+    }
+    if args.sqlite:
+        database = os.path.join(tempfile.mkdtemp(prefix="startup-bench-"), "bench.sqlite")
+        env["DATABASE_URL"] = f"sqlite:///{database}"
+        env["ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{database}"
+        # No LISTEN on SQLite
+        env.setdefault("NOTIFY_RECONNECT_SECONDS", "3600")
+
+    results = {}
+    try:
+        if spawn(args, "migrate", env).wait(args.timeout) != 0:
+            sys.exit("Migration failed")
+        for warmup in args.warmup:
+            runs = [measure(args, {**env, "WARMUP": warmup}) for _ in range(args.runs)]
+            label = warmup or "none"
+            results[label] = summarize(runs)
+            print(f"{label:<10}" + "  ".join(f"{key} {value}" for key, value in results[label].items()))
+    finally:
+        s3_server.stop()
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"startedAt": datetime.now().isoformat(), "config": vars(args), "warmup": results},
+                      output, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()